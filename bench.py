@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+#            DO WHAT THE FUCK YOU WANT TO PUBLIC LICENSE
+#                    Version 2, December 2004
+#
+# Copyright (C) 2008 Konstantin Merenkov <kmerenkov@gmail.com>
+# Everyone is permitted to copy and distribute verbatim or modified
+# copies of this license document, and changing it is allowed as long
+# as the name is changed.
+#
+#            DO WHAT THE FUCK YOU WANT TO PUBLIC LICENSE
+#   TERMS AND CONDITIONS FOR COPYING, DISTRIBUTION AND MODIFICATION
+#
+#  0. You just DO WHAT THE FUCK YOU WANT TO.
+
+"""
+Benchmarks for validol.
+
+Every scenario validates one record over and over for a while and reports
+operations per second, latency percentiles of a single validation and peak
+memory of the process that ran it. Results can be saved to JSON and
+compared against a saved baseline:
+
+    python bench.py --output baseline.json
+    ... hack hack hack ...
+    python bench.py --baseline baseline.json
+
+Exit status is 1 if any scenario got slower than the threshold allows.
+"""
+
+__author__  = "Konstantin Merenkov <kmerenkov@gmail.com>"
+
+
+import sys
+import re
+import json
+import time
+import resource
+import argparse
+import multiprocessing
+
+import validol
+from validol import Many, Optional, AnyOf, Scheme, Text
+
+
+def scenario_dict_flat():
+    scheme = dict(("key%d" % i, int) for i in xrange(20))
+    good = dict(("key%d" % i, i) for i in xrange(20))
+    bad = dict(good, key0='0')
+    return scheme, good, bad
+
+def scenario_dict_nested():
+    leaf = {'id': int, 'name': str, 'price': float}
+    scheme = {'order': {'id': int, 'customer': {'id': int, 'name': str},
+                        'items': [leaf]}}
+    good = {'order': {'id': 1, 'customer': {'id': 2, 'name': 'foo'},
+                      'items': [{'id': i, 'name': 'item', 'price': 1.5} for i in xrange(10)]}}
+    bad = {'order': {'id': 1, 'customer': {'id': '2', 'name': 'foo'}, 'items': []}}
+    return scheme, good, bad
+
+def scenario_dict_optional():
+    scheme = dict((Optional(str(i)), int) for i in xrange(1000))
+    good = dict((str(i), i) for i in xrange(0, 1000, 2))
+    bad = dict(good, foo=1)
+    return scheme, good, bad
+
+def scenario_dict_many():
+    scheme = {Many(str): int, Many(int): str, 'version': int}
+    good = dict(("key%d" % i, i) for i in xrange(1000))
+    good.update((i, str(i)) for i in xrange(100))
+    good['version'] = 1
+    bad = dict(good)
+    del bad['version']
+    return scheme, good, bad
+
+def scenario_list_long():
+    scheme = [int]
+    good = range(100000)
+    bad = ['0'] + range(100000)
+    return scheme, good, bad
+
+def scenario_list_dicts():
+    scheme = [{'id': int, 'name': Text(), Optional('email'): str}]
+    good = [{'id': i, 'name': 'user'} for i in xrange(1000)]
+    bad = [{'id': 'x', 'name': 'user'}] + good
+    return scheme, good, bad
+
+def scenario_list_mixed():
+    scheme = [int, str, {'id': int}]
+    good = [1, 'foo', {'id': 2}] * 1000
+    bad = [None] + good
+    return scheme, good, bad
+
+def scenario_tuple_wide():
+    scheme = tuple([int, str, float] * 100)
+    good = tuple([1, 'foo', 1.5] * 100)
+    bad = ('1',) + good[1:]
+    return scheme, good, bad
+
+def scenario_anyof_values():
+    scheme = AnyOf(*range(500))
+    return scheme, 499, 500
+
+def scenario_scheme_fanout():
+    scheme = Scheme(*[{'type': 'message%d' % i, 'body': str} for i in xrange(40)])
+    good = {'type': 'message39', 'body': 'foo'}
+    bad = {'type': 'message40', 'body': 'foo'}
+    return scheme, good, bad
+
+def scenario_regex():
+    scheme = {Many(re.compile(r'^\w+$')): re.compile(r'^\d+$')}
+    good = dict(("key%d" % i, str(i)) for i in xrange(100))
+    bad = dict(good, key0='x')
+    return scheme, good, bad
+
+def scenario_callable():
+    scheme = [lambda x: x >= 0]
+    good = range(10000)
+    bad = [-1] + good
+    return scheme, good, bad
+
+
+SCENARIOS = [(name[len('scenario_'):], function)
+             for name, function in sorted(globals().items())
+             if name.startswith('scenario_')]
+
+
+def get_validator(scheme, backend):
+    if backend == 'interpreted':
+        return lambda data: validol.validate_common(scheme, data)
+    return validol.compile(scheme, backend=backend)
+
+def percentile(sorted_values, fraction):
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return sorted_values[index]
+
+def measure(validator, data, duration):
+    """ Returns (ops/sec, [latencies]) of validating data for about duration seconds. """
+    timer = time.time
+    latencies = []
+    started = timer()
+    finished = started
+    while finished - started < duration:
+        before = timer()
+        validator(data)
+        finished = timer()
+        latencies.append(finished - before)
+    return len(latencies) / (finished - started), latencies
+
+def run_scenario(name, function, backend, duration):
+    """ Runs a scenario in a fresh process, so peak memory is its own. """
+    scheme, good, bad = function()
+    validator = get_validator(scheme, backend)
+    # the interpreted engine is the reference, every backend must agree with it
+    for data in (good, bad):
+        assert validator(data) == validol.validate_common(scheme, data), \
+            "backend %s disagrees with validate_common in scenario %s" % (backend, name)
+    assert validator(good) and not validator(bad), "scenario %s is broken" % name
+    result = {}
+    for case, data in [('good', good), ('bad', bad)]:
+        ops, latencies = measure(validator, data, duration)
+        latencies.sort()
+        result[case] = {'ops': ops,
+                        'p50_us': percentile(latencies, 0.5) * 1e6,
+                        'p90_us': percentile(latencies, 0.9) * 1e6,
+                        'p99_us': percentile(latencies, 0.99) * 1e6}
+    # ru_maxrss is in kilobytes on linux
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+def _run_scenario(args):
+    return run_scenario(*args)
+
+def compare(results, baseline, threshold):
+    """ Returns list of (scenario, case, baseline ops, ops) that got slower. """
+    regressions = []
+    for name, result in sorted(results.iteritems()):
+        if name not in baseline:
+            continue
+        for case in ('good', 'bad'):
+            old = baseline[name][case]['ops']
+            new = result[case]['ops']
+            if new < old * (1 - threshold):
+                regressions.append((name, case, old, new))
+    return regressions
+
+def report(results, out=sys.stdout):
+    out.write("%-16s %-5s %12s %10s %10s %10s %10s\n" %
+              ("scenario", "case", "ops/sec", "p50 us", "p90 us", "p99 us", "peak KB"))
+    for name, result in sorted(results.iteritems()):
+        for case in ('good', 'bad'):
+            stats = result[case]
+            out.write("%-16s %-5s %12.1f %10.1f %10.1f %10.1f %10d\n" %
+                      (name, case, stats['ops'], stats['p50_us'], stats['p90_us'],
+                       stats['p99_us'], result['peak_rss_kb']))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for validol.")
+    parser.add_argument('scenarios', nargs='*', help="scenarios to run (default: all)")
+    parser.add_argument('--backend', default='tree', choices=['tree', 'codegen', 'interpreted'])
+    parser.add_argument('--duration', type=float, default=1.0,
+                        help="seconds to spend on every case (default: %(default)s)")
+    parser.add_argument('--output', help="write results to this JSON file")
+    parser.add_argument('--baseline', help="compare results with this JSON file")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="slowdown that counts as a regression (default: %(default)s)")
+    parser.add_argument('--list', action='store_true', help="list scenarios and exit")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name, function in SCENARIOS:
+            print name
+        return 0
+    scenarios = [(name, function) for name, function in SCENARIOS
+                 if not args.scenarios or name in args.scenarios]
+    results = {}
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        for name, function in scenarios:
+            results[name] = pool.apply(_run_scenario, [(name, function, args.backend, args.duration)])
+    finally:
+        pool.close()
+        pool.join()
+    report(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'backend': args.backend, 'results': results}, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for name, case, old, new in regressions:
+            print "REGRESSION %s/%s: %.1f -> %.1f ops/sec (%+.1f%%)" % \
+                (name, case, old, new, (new / old - 1) * 100)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
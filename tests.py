@@ -19,7 +19,22 @@ __author__  = "Konstantin Merenkov <kmerenkov@gmail.com>"
 
 import unittest
 import re
-from validol import validate, AnyOf, Many, Optional, Scheme, BaseValidator, Text
+import os
+import sys
+import threading
+import json
+import tempfile
+from decimal import Decimal
+from fractions import Fraction
+from StringIO import StringIO
+from validol import validate, validate_common, compile, AnyOf, Many, Optional, Scheme, BaseValidator, Text, \
+     Tagged, Profiler, validate_many, validate_stream, main, loads, ValidationError, \
+     validate_iterative, Ref, Define, Limits, LimitExceeded, Sample, validate_detailed, \
+     Coerce, Default, parse, revalidate, lazy, Memo, pure, intern, TooDeep
+
+
+class _Str(str):
+    pass
 
 
 class BaseValidatorTestCase(unittest.TestCase):
@@ -31,7 +46,7 @@ class BaseValidatorTestCase(unittest.TestCase):
     def test_good_002(self):
         """ all validators must be inherited from BaseValidator """
         # I don't really think it belongs to this test case
-        for v in [AnyOf, Many, Optional, Scheme]:
+        for v in [AnyOf, Many, Optional, Scheme, Tagged, Ref, Define]:
             result = issubclass(v, BaseValidator)
             self.assertTrue(result)
 
@@ -59,6 +74,76 @@ class SchemeTestCase(unittest.TestCase):
         self.assertFalse(s.validate({'foo': 'bar'}))
 
 
+class TaggedTestCase(unittest.TestCase):
+    scheme = Tagged('type', {'user': {'type': 'user', 'id': int},
+                             'group': {'type': 'group', 'users': [int]}})
+
+    def test_good_001(self):
+        self.assertTrue(validate(self.scheme, {'type': 'user', 'id': 10}))
+        self.assertTrue(validate(self.scheme, {'type': 'group', 'users': [10]}))
+
+    def test_bad_001(self):
+        self.assertFalse(validate(self.scheme, {'type': 'user', 'users': [10]}))
+        self.assertFalse(validate(self.scheme, {'type': 'admin', 'id': 10}))
+        self.assertFalse(validate(self.scheme, {'type': ['user'], 'id': 10}))
+        self.assertFalse(validate(self.scheme, {'id': 10}))
+        self.assertFalse(validate(self.scheme, [10]))
+
+    def test_good_002(self):
+        """ AnyOf picks the scheme by the key on its own """
+        x = AnyOf({'type': 'user', 'id': int}, {'type': 'group', 'users': [int]})
+        self.assertTrue(validate(x, {'type': 'group', 'users': [10]}))
+        self.assertFalse(validate(x, {'type': 'group', 'id': 10}))
+        self.assertFalse(validate(x, {'type': 'user'}))
+
+    def test_good_003(self):
+        """ schemes without distinct tags are tried one by one """
+        x = Scheme({'type': 'user', 'id': int}, {'type': 'user', 'name': str})
+        self.assertTrue(validate(x, {'type': 'user', 'name': 'foo'}))
+        self.assertFalse(validate(x, {'type': 'user', 'name': 10}))
+
+
+class DefineTestCase(unittest.TestCase):
+    scheme = Define(Ref('comment'),
+                    comment={'text': Text(), Optional('replies'): Ref('replies')},
+                    replies=[Ref('comment')])
+
+    def tree(self, depth, text='foo'):
+        tree = {'text': text}
+        for i in xrange(depth):
+            tree = {'text': 'foo', 'replies': [tree, {'text': 'bar'}]}
+        return tree
+
+    def test_good_001(self):
+        data = self.tree(10)
+        self.assertTrue(validate(self.scheme, data))
+        self.assertTrue(validate_common(self.scheme, data))
+        self.assertTrue(validate_iterative(self.scheme, data))
+        self.assertTrue(compile(self.scheme, backend="codegen")(data))
+
+    def test_bad_001(self):
+        self.assertFalse(validate(self.scheme, self.tree(10, text=10)))
+        self.assertFalse(validate_common(self.scheme, self.tree(10, text=10)))
+        self.assertFalse(validate_iterative(self.scheme, self.tree(10, text=10)))
+
+    def test_good_002(self):
+        """ deep trees are fine without recursion """
+        self.assertTrue(validate_iterative(self.scheme, self.tree(5000)))
+        self.assertFalse(validate_iterative(self.scheme, self.tree(5000, text=None)))
+
+    def test_good_003(self):
+        """ nested Define sees names of the outer one """
+        scheme = Define({'a': Ref('inner')},
+                        inner=Define([Ref('x')], x=Ref('outer')),
+                        outer=int)
+        self.assertTrue(validate(scheme, {'a': [1, 2]}))
+        self.assertFalse(validate(scheme, {'a': [1, '2']}))
+
+    def test_bad_002(self):
+        self.assertRaises(ValueError, validate, Define([Ref('foo')]), [1])
+        self.assertRaises(ValueError, validate_common, Define([Ref('foo')]), [1])
+
+
 class OptionalTestCase(unittest.TestCase):
     def test_good_001(self):
         x = Optional(str)
@@ -102,6 +187,19 @@ class AnyOfTestCase(unittest.TestCase):
             }
         self.assertFalse(validate(x, {10: 'foo', 'bar': 'zar'}))
 
+    def test_good_004(self):
+        """ values, types and schemes may be mixed """
+        x = AnyOf(*(range(500) + [str, [int], None]))
+        for data in [499, 'foo', [1, 2], None]:
+            self.assertTrue(x.validate(data))
+            self.assertTrue(validate(x, data))
+
+    def test_bad_004(self):
+        x = AnyOf(*(range(500) + [str, [int]]))
+        for data in [500, u'foo', ['foo'], {}, None]:
+            self.assertFalse(x.validate(data))
+            self.assertFalse(validate(x, data))
+
 
 class ListTestCase(unittest.TestCase):
     def test_good_001(self):
@@ -148,6 +246,45 @@ class ListTestCase(unittest.TestCase):
         x = ()
         self.assertFalse(validate(x, []))
 
+    def test_good_006(self):
+        """ lists checked by types or values alone """
+        self.assertTrue(validate([Text()], ['foo', u'bar']))
+        self.assertTrue(validate([Optional(int)], [1, None, 2]))
+        self.assertTrue(validate([AnyOf(int, str)], [1, 'foo']))
+        self.assertTrue(validate(['foo'], ['foo', u'foo']))
+        self.assertTrue(validate((int, 'foo'), (1, 'foo')))
+        self.assertTrue(validate(('foo', 1), ('foo', True)))
+
+    def test_bad_007(self):
+        self.assertFalse(validate([Text()], ['foo', 1]))
+        self.assertFalse(validate([Optional(int)], [1, None, 2.0]))
+        self.assertFalse(validate([int], [1, True]))
+        self.assertFalse(validate(['foo'], ['foo', 'bar']))
+        self.assertFalse(validate((int, str), (1, u'foo')))
+        self.assertFalse(validate(('foo', 1), ('foo', 1, 1)))
+
+    def test_good_007(self):
+        """ every item of list may match any of validators """
+        x = [int, str, {'id': int}]
+        self.assertTrue(validate(x, [1, 'foo', {'id': 2}, 3]))
+        self.assertTrue(validate(x, []))
+        self.assertTrue(validate([int, Text()], [1, u'foo']))
+
+    def test_bad_008(self):
+        x = [int, str, {'id': int}]
+        self.assertFalse(validate(x, [1, 'foo', {'id': 'bar'}]))
+        self.assertFalse(validate(x, [1, 'foo', 2.0]))
+        self.assertFalse(validate([int, Text()], [1, None]))
+
+    def test_bad_009(self):
+        """ a wrong item anywhere in a long list, which is checked in chunks """
+        for scheme in ([int], [int, str]):
+            for compiled in (compile(scheme), compile(scheme, backend="codegen")):
+                self.assertTrue(compiled(range(1000)))
+                for i in (0, 63, 64, 191, 192, 999):
+                    data = range(1000)
+                    data[i] = None
+                    self.assertFalse(compiled(data), (scheme, i))
 
 
 class DictTestCase(unittest.TestCase):
@@ -203,6 +340,31 @@ class DictTestCase(unittest.TestCase):
         x = {str: {str: str}}
         self.assertFalse(validate(x, {'foo': {'bar': 10}}))
 
+    def test_literal_good_001(self):
+        """ literal key is preferred over Many key matching the same data key """
+        x = {Many(str): int, 'a': int}
+        self.assertTrue(validate(x, {'a': 1, 'b': 2}))
+
+    def test_literal_bad_001(self):
+        """ value rejected by literal key is still tried against other keys """
+        x = {'a': int, str: str}
+        self.assertTrue(validate(x, {'a': 1, 'b': 'c'}))
+        self.assertFalse(validate(x, {'a': 'b'}))
+
+    def test_many_good_001(self):
+        x = {Many(str): int, Many(int): str, 'version': int}
+        self.assertTrue(validate(x, {'a': 1, 'b': 2, 1: 'a', 'version': 3}))
+
+    def test_many_bad_001(self):
+        x = {Many(str): int, Many(int): str, 'version': int}
+        self.assertFalse(validate(x, {'a': 1, 1: 2, 'version': 3}))
+        self.assertFalse(validate(x, {'a': 1, 1.5: 'a', 'version': 3}))
+
+    def test_many_bad_002(self):
+        """ regex keys do not choke on keys that are not strings """
+        x = {Many(re.compile('\d+')): str}
+        self.assertFalse(validate(x, {'10': 'foo', 20: 'bar'}))
+
     def test_optional_good_001(self):
         x = {str: Optional(10)}
         self.assertTrue(validate(x, {'foo': 10}))
@@ -235,6 +397,16 @@ class DictTestCase(unittest.TestCase):
         x = {'a': 'b', 'c': 'd', Optional('foo'): 'bar', Optional('zoo'): 'xar'}
         self.assertFalse(validate(x, {'a': 'b', 'c': 'd', 'zoo': 'bar'}))
 
+    def test_optional_good_005(self):
+        x = {Optional('a'): int, Optional('b'): int, 'c': int}
+        self.assertTrue(validate(x, {'c': 1, 'b': 2}))
+        self.assertTrue(validate(x, {'c': 1}))
+
+    def test_optional_bad_005(self):
+        x = {Optional('a'): int, Optional('b'): int, 'c': int}
+        self.assertFalse(validate(x, {'c': 1, 'b': 'x'}))
+        self.assertFalse(validate(x, {'b': 2}))
+
 
 class TextTestCase(unittest.TestCase):
     def test_str_001(self):
@@ -369,5 +541,731 @@ class SamplesTestCase(unittest.TestCase):
         self.assertFalse(validate(scheme, d))
 
 
+class CompileTestCase(unittest.TestCase):
+    """ compiled schemes must agree with validate_common """
+
+    samples = [
+        (int, 10), (int, '10'), (object, None), (10, 10), (10, 11),
+        (re.compile('\d+'), '10'), (re.compile('\d+'), 'foo'),
+        (lambda x: x > 0, 1), (lambda x: len(x) > 0, 10),
+        ([], []), ([], [1]), ([int], [1, 2]), ([int], [1, 'a']), ([int], ()),
+        ((), ()), ((int, str), (1, 'a')), ((int, str), (1, 2)), ((int,), [1]),
+        ({}, {}), ({}, {'a': 1}), ({str: str}, {}), ({object: object}, {1: 2}),
+        ({'a': int}, {'a': 1}), ({'a': int}, {'a': 1, 'b': 2}),
+        ({Many(str): int}, {'a': 1, 'b': 2}), ({Many(str): int}, {}),
+        ({Many(str): int, 'c': str}, {'a': 1, 'c': 'd'}),
+        ({Optional('a'): int, 'b': int}, {'b': 1}),
+        ({Optional('a'): int, 'b': int}, {'a': 'x', 'b': 1}),
+        ({Optional(str): int}, {'a': 'b'}),
+        ({AnyOf(int, str): str}, {10: 'foo', 'bar': 'zar'}),
+        ({Many(str): int, 'version': int}, {'a': 2, 'version': 1}),
+        ({Many(str): str, 'version': int}, {'a': 'b', 'version': 'c'}),
+        ({Optional('a'): int, Optional(str): str}, {'a': 'x'}),
+        (AnyOf(1, 2, 3), 3), (Scheme({'id': int}, {'name': str}), {'name': 'x'}),
+        (Scheme({Many(str): int, 'version': int}), {'a': 2, 'version': 1}),
+        (Optional(str), None), (Text(), u'abc'), (Text(), 10),
+        # equal values and strings matched by regexes may be of other types
+        ([1, str], [Decimal(1), Fraction(2, 2)]), ([AnyOf(1, 'x'), None], [Decimal(1), None]),
+        ([re.compile('^a'), int], [_Str('ab')]), ({Many(re.compile('^a')): int}, {_Str('ab'): 1}),
+        (['a', int], [_Str('a')]), ([Text(), int], [_Str('a')]),
+        ]
+
+    def test_good_001(self):
+        for scheme, data in self.samples:
+            self.assertEqual(compile(scheme)(data), validate_common(scheme, data))
+
+    def test_good_002(self):
+        """ shared parts of a scheme are compiled once """
+        item = {'id': int}
+        compiled = compile({'a': item, 'b': [item]})
+        self.assertTrue(compiled({'a': {'id': 1}, 'b': [{'id': 2}]}))
+        self.assertFalse(compiled({'a': {'id': 1}, 'b': [{'id': '2'}]}))
+
+    def test_good_004(self):
+        """ validate notices changes to a scheme it has compiled """
+        scheme = {'a': int}
+        for i in xrange(3):
+            self.assertTrue(validate(scheme, {'a': 1}))
+        scheme['b'] = int
+        self.assertFalse(validate(scheme, {'a': 1}))
+        scheme['b'] = Optional(int)
+        self.assertFalse(validate(scheme, {'a': 1}))
+        scheme = [int]
+        for i in xrange(3):
+            self.assertFalse(validate(scheme, ['1']))
+        scheme[0] = str
+        self.assertTrue(validate(scheme, ['1']))
+
+    def test_good_005(self):
+        """ the first and the following calls agree """
+        for scheme, data in self.samples + [([int, re.compile('^a')], [1.5]), (re.compile('^a'), 1)]:
+            self.assertEqual([validate(scheme, data) for i in xrange(3)], [validate_common(scheme, data)] * 3)
+        # keys are tried greedily in the order of the scheme, which depends on
+        # where the regex happens to be in memory
+        data = {'a0': 'a', 'b': 1.0, 'x': 'a'}
+        for i in xrange(30):
+            regex = re.compile('^a' + '(?:)' * i)
+            for scheme in [{'b': float, regex: 'a', str: str},
+                           {Optional('b'): float, Optional(regex): 'a', Optional(str): str, Many(str): object}]:
+                self.assertEqual([validate(scheme, data) for n in xrange(3)], [compile(scheme)(data)] * 3)
+
+    def test_good_006(self):
+        """ validate may be called from several threads, while the cache is evicted """
+        schemes = [{'id': int, 'n%d' % i: [int]} for i in xrange(3000)]
+        results = []
+        def run():
+            try:
+                results.append(all(validate(scheme, {'id': 1, 'n%d' % i: [i]})
+                                   for n in xrange(2) for i, scheme in enumerate(schemes)))
+            except Exception, e:
+                results.append(e)
+        threads = [threading.Thread(target=run) for i in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [True] * 8)
+
+    def test_good_003(self):
+        """ custom validators are asked through their validate method """
+        class Even(BaseValidator):
+            def validate(self, data):
+                return data % 2 == 0
+        self.assertTrue(compile([Even()])([2, 4]))
+        self.assertFalse(compile([Even()])([2, 3]))
+
+
+class CodegenTestCase(unittest.TestCase):
+    """ generated validators must agree with validate_common """
+
+    def test_good_001(self):
+        for scheme, data in CompileTestCase.samples:
+            compiled = compile(scheme, backend="codegen")
+            self.assertEqual(compiled(data), validate_common(scheme, data))
+
+    def test_good_002(self):
+        scheme = {'id': int,
+                  Optional('tags'): [Text()],
+                  'items': [{'name': str, 'size': (int, int), Optional('note'): Optional(str)}],
+                  'extra': {Many(str): lambda x: x > 0}}
+        compiled = compile(scheme, backend="codegen")
+        data = {'id': 1,
+                'items': [{'name': 'a', 'size': (1, 2)}, {'name': 'b', 'size': (3, 4), 'note': None}],
+                'extra': {'x': 1}}
+        self.assertTrue(compiled(data))
+        data['items'][1]['size'] = (3, '4')
+        self.assertFalse(compiled(data))
+        self.assertTrue("def validate" in compiled.source)
+
+    def test_good_003(self):
+        """ parts that need no code leave no empty blocks """
+        for scheme, good, bad in [({'a': Optional(object)}, {'a': 1}, {}), ([Optional(object)], [None, 1], ()),
+                                  (Optional(object), 1, None)]:
+            compiled = compile(scheme, backend="codegen")
+            self.assertTrue(compiled(good))
+            self.assertEqual(compiled(bad), validate_common(scheme, bad))
+
+    def test_good_004(self):
+        """ deep schemes are not indented past what python allows """
+        scheme = data = 1
+        for i in xrange(120):
+            scheme = {Optional('a'): scheme}
+            data = {'a': data}
+        compiled = compile(scheme, backend="codegen")
+        self.assertTrue(compiled(data))
+        self.assertTrue(compiled({}))
+
+    def test_bad_001(self):
+        self.assertRaises(ValueError, compile, int, backend="foo")
+
+
+class ProfilerTestCase(unittest.TestCase):
+    scheme = {'items': [{'price': int, Optional('name'): str}]}
+
+    def test_good_001(self):
+        profiler = Profiler()
+        self.assertTrue(validate(self.scheme, {'items': [{'price': 1}, {'price': 2}]}, profiler=profiler))
+        self.assertFalse(validate(self.scheme, {'items': [{'price': '3'}]}, profiler=profiler))
+        calls, total, own, passed, failed = profiler.stats[("['items']", '[*]', "['price']")]
+        self.assertEqual((calls, passed, failed), (3, 2, 1))
+        self.assertEqual(profiler.stats[()][3:], [1, 1])
+        self.assertTrue(total >= own >= 0)
+
+    def test_good_002(self):
+        profiler = Profiler()
+        validate(self.scheme, {'items': [{'price': 1, 'name': 'foo'}]}, profiler=profiler)
+        self.assertTrue("['items'][*]['name']" in profiler.table())
+        self.assertTrue("(root);['items'];[*];['name'] " in profiler.folded())
+        profiler.reset()
+        self.assertEqual(profiler.stats[()], [0, 0.0, 0.0, 0, 0])
+
+
+class LimitsTestCase(unittest.TestCase):
+    def test_good_001(self):
+        """ within limits results are the same """
+        limits = Limits(max_items=10**6, max_depth=100, max_ops=10**6, deadline=60)
+        for scheme, data in CompileTestCase.samples:
+            self.assertEqual(validate(scheme, data, limits=limits), validate(scheme, data))
+
+    def test_good_002(self):
+        tree = Define(Ref('node'), node={'value': int, Optional('children'): [Ref('node')]})
+        data = {'value': 1}
+        for i in xrange(10):
+            data = {'value': i, 'children': [data]}
+        self.assertTrue(validate(tree, data, limits=Limits(max_depth=21)))
+        self.assertEqual(validate(tree, data, limits=Limits(max_depth=20)), LimitExceeded('max_depth'))
+
+    def test_bad_001(self):
+        scheme = {Many(re.compile('^key')): int, Optional('version'): int}
+        data = dict(('key%d' % i, i) for i in xrange(10000))
+        result = validate(scheme, data, limits=Limits(max_items=1000))
+        self.assertFalse(result)
+        self.assertEqual(result.limit, 'max_items')
+        self.assertEqual(validate(scheme, data, limits=Limits(max_ops=100)), LimitExceeded('max_ops'))
+        self.assertEqual(validate([lambda x: True], range(10000), limits=Limits(deadline=0.0001)),
+                         LimitExceeded('deadline'))
+
+    def test_bad_002(self):
+        self.assertRaises(ValueError, validate, int, 1, profiler=Profiler(), limits=Limits())
+
+
+class SampleTestCase(unittest.TestCase):
+    def test_good_001(self):
+        """ with everything sampled results are the same """
+        sample = Sample(fraction=1.0)
+        for scheme, data in CompileTestCase.samples:
+            self.assertEqual(bool(validate(scheme, data, sample=sample)), validate(scheme, data))
+
+    def test_good_002(self):
+        data = range(10000)
+        data[5000] = 'x'
+        sample = Sample(fraction=0.1, seed=42)
+        results = [validate([int], data, sample=sample) for i in xrange(3)]
+        self.assertEqual(len(set((r.valid, r.checked) for r in results)), 1)
+        self.assertEqual(results[0].checked, 1000)
+        found = [validate([int], data, sample=Sample(count=100, seed=seed)) for seed in xrange(1000)]
+        self.assertTrue(not all(found) and any(found))
+
+    def test_good_003(self):
+        """ keys that are not Many are always checked """
+        scheme = {'version': int, Many(str): int}
+        data = dict(('key%d' % i, i) for i in xrange(100))
+        data['version'] = 1
+        result = validate(scheme, data, sample=Sample(count=5))
+        self.assertTrue(result)
+        self.assertEqual(result.checked, 6)
+        data['version'] = '1'
+        self.assertFalse(validate(scheme, data, sample=Sample(count=5)))
+        del data['version']
+        self.assertFalse(validate(scheme, data, sample=Sample(count=5)))
+
+    def test_bad_001(self):
+        self.assertRaises(ValueError, Sample)
+        self.assertRaises(ValueError, validate, [int], [1], sample=Sample(count=1), limits=Limits())
+
+
+class ValidateDetailedTestCase(unittest.TestCase):
+    def test_good_001(self):
+        """ errors are found if and only if data is invalid """
+        for scheme, data in CompileTestCase.samples:
+            errors = validate_detailed(scheme, data, max_errors=None)
+            self.assertEqual(not errors, validate(scheme, data))
+            for error in errors:
+                self.assertTrue(isinstance(error, ValidationError))
+
+    def test_good_002(self):
+        scheme = {'order': {'id': int, Optional('note'): str,
+                            'items': [{'price': float, Many(str): int}],
+                            'kind': Tagged('type', {'a': {'type': 'a'}, 'b': {'type': 'b', 'x': int}})}}
+        data = {'order': {'id': '1', 'note': None, 'extra': 1,
+                          'items': [{'price': 1.0, 'a': 1}, {'price': 2.0, 'b': 'x'}],
+                          'kind': {'type': 'c'}}}
+        errors = validate_detailed(scheme, data, max_errors=None)
+        found = dict((error.path, (error.expected, error.actual)) for error in errors)
+        self.assertEqual(found, {('order', 'id'): (int, '1'),
+                                 ('order', 'note'): (str, None),
+                                 ('order', 'extra'): (scheme['order'], 1),
+                                 ('order', 'items', 1, 'b'): (int, 'x'),
+                                 ('order', 'kind', 'type'): (scheme['order']['kind'], 'c')})
+        self.assertEqual(len(validate_detailed(scheme, data)), 1)
+        self.assertEqual(len(validate_detailed(scheme, data, max_errors=3)), 3)
+
+    def test_bad_001(self):
+        errors = validate_detailed({'id': int, Many(str): int}, {'id': 1}, max_errors=None)
+        self.assertEqual(errors, [])
+        errors = validate_detailed({'id': int, str: int}, {'id': 1}, max_errors=None)
+        self.assertEqual([(e.path, e.expected, e.actual) for e in errors], [((), str, {'id': 1})])
+        self.assertEqual(str(errors[0]), "Missing key at $")
+        errors = validate_detailed((int, str), (1, 2, 3))
+        self.assertEqual(errors[0].path, ())
+
+    def test_bad_002(self):
+        """ alternatives that cannot take the data type """
+        errors = validate_detailed([int, re.compile('^a')], [1, 'ab', 1.5])
+        self.assertEqual([e.path for e in errors], [(2,)])
+        for scheme, paths in [([int, float], [(0,), (2,)]), ([Text(), int], [(2,)])]:
+            errors = validate_detailed(scheme, ['x', 1, None], max_errors=None)
+            self.assertEqual([e.path for e in errors], paths)
+        errors = validate_detailed({Many(re.compile('^a')): int, Optional(re.compile('^b')): int}, {'a': 1, 1: 2})
+        self.assertEqual([(e.path, e.message) for e in errors], [((1,), "Unexpected key at $[1]")])
+
+
+class ParseTestCase(unittest.TestCase):
+    def test_good_001(self):
+        """ without Coerce and Default data is returned as it is """
+        for scheme, data in CompileTestCase.samples:
+            if validate(scheme, data):
+                self.assertTrue(parse(scheme, data) is data)
+            else:
+                self.assertRaises(ValidationError, parse, scheme, data)
+
+    def test_good_002(self):
+        number = Coerce(int, int)
+        scheme = {'id': number, 'items': [{'count': number, 'name': str}],
+                  'pair': (number, str), Optional('limit'): Default(10, int),
+                  Optional('page'): Default(1, int), Many(re.compile('^x-')): Optional(number)}
+        data = {'id': '1', 'items': [{'count': 2, 'name': 'foo'}, {'count': '3', 'name': 'bar'}],
+                'pair': (1, 'foo'), 'page': 2, 'x-a': None, 'x-b': '5'}
+        result = parse(scheme, data)
+        self.assertEqual(result, {'id': 1, 'items': [{'count': 2, 'name': 'foo'}, {'count': 3, 'name': 'bar'}],
+                                  'pair': (1, 'foo'), 'limit': 10, 'page': 2, 'x-a': None, 'x-b': 5})
+        self.assertTrue(result['items'][0] is data['items'][0])
+        self.assertTrue(result['pair'] is data['pair'])
+        self.assertEqual(data['id'], '1')
+        self.assertTrue(validate(scheme, data))
+
+    def test_good_003(self):
+        scheme = [AnyOf(None, Coerce(int, int), Coerce(float, float))]
+        self.assertEqual(parse(scheme, [None, '1', '1.5', 2]), [None, 1, 1.5, 2])
+        tree = Define(Ref('node'), node={'value': Coerce(int, int), Optional('children'): [Ref('node')]})
+        self.assertEqual(parse(tree, {'value': '1', 'children': [{'value': '2'}]}),
+                         {'value': 1, 'children': [{'value': 2}]})
+
+    def test_bad_001(self):
+        scheme = {'id': Coerce(int, int), 'items': [Coerce(int, int)]}
+        try:
+            parse(scheme, {'id': '1', 'items': ['1', 'x']})
+        except ValidationError, e:
+            self.assertEqual((e.path, e.actual), (('items', 1), 'x'))
+        else:
+            self.fail("ValidationError expected")
+        self.assertFalse(validate(scheme, {'id': '1', 'items': ['1', 'x']}))
+        self.assertRaises(ValidationError, parse, scheme, {'id': '1'})
+        self.assertRaises(ValidationError, parse, scheme, {'id': '1', 'items': [], 'foo': 1})
+
+    def test_bad_002(self):
+        """ a dict with only optional keys, while some key is required """
+        number = Coerce(int, int)
+        for scheme, data in [({Many(str): number}, {}),
+                             ({Optional('a'): number, Many(str): int}, {'a': '1'}),
+                             ({Optional('a'): number, 'b': int}, {'a': '1'})]:
+            self.assertFalse(validate(scheme, data))
+            self.assertRaises(ValidationError, parse, scheme, data)
+        self.assertEqual(parse({Optional('a'): number, Many(str): int}, {'a': '1', 'b': 2}), {'a': 1, 'b': 2})
+
+    def test_bad_003(self):
+        """ a key taken by Optional (or by a plain key) is not given to another validator """
+        number = Coerce(int, int)
+        for scheme, data in [({Optional('a'): number, Many(str): str}, {'a': 'x'}),
+                             ({Optional('b'): int, Optional(str): number}, {'b': '3'}),
+                             ({'a': number, str: str}, {'a': 'x'}),
+                             ({'a': number, Optional(str): object}, {'a': '1'})]:
+            self.assertFalse(validate(scheme, data))
+            self.assertRaises(ValidationError, parse, scheme, data)
+
+
+class RevalidateTestCase(unittest.TestCase):
+    scheme = {'id': int, Optional('tags'): [str], 'items': [{'price': int, Optional('name'): Optional(str)}],
+              Many(re.compile('^x-')): int, 'meta': Tagged('type', {'a': {'type': 'a', 'value': int}}),
+              'pair': (int, [int])}
+
+    def document(self):
+        return {'id': 1, 'tags': ['foo'], 'items': [{'price': 1}, {'price': 2, 'name': None}],
+                'x-a': 1, 'meta': {'type': 'a', 'value': 1}, 'pair': (1, [2])}
+
+    def test_good_001(self):
+        """ must agree with validate """
+        changes = [(('id',), '1'), (('tags', 0), 1), (('tags', 1), 'bar'), (('items', 0, 'price'), '1'),
+                   (('items', 1, 'name'), 'foo'), (('items', 1, 'name'), 1), (('items', 0, 'foo'), 1),
+                   (('x-b',), 2), (('x-b',), '2'), (('y',), 1), (('meta', 'value'), '1'),
+                   (('meta', 'type'), 'b'), (('pair', 1, 0), '2'), (('pair', 1, 1), 3), (('items', 2), {})]
+        for path, value in changes:
+            data = self.document()
+            parent = data
+            for key in path[:-1]:
+                parent = parent[key]
+            if type(parent) is list and path[-1] == len(parent):
+                parent.append(value)
+            else:
+                parent[path[-1]] = value
+            self.assertEqual(revalidate(self.scheme, data, [path]), validate(self.scheme, data), path)
+
+    def test_good_002(self):
+        """ removals """
+        for path in [('id',), ('tags',), ('x-a',), ('items', 1, 'name'), ('items', 0, 'price'), ('meta', 'value')]:
+            data = self.document()
+            parent = data
+            for key in path[:-1]:
+                parent = parent[key]
+            del parent[path[-1]]
+            self.assertEqual(revalidate(self.scheme, data, [path]), validate(self.scheme, data), path)
+
+    def test_good_003(self):
+        data = self.document()
+        data['items'].append({'price': 3})
+        data['x-b'] = 1
+        self.assertTrue(revalidate(self.scheme, data, [{'op': 'add', 'path': '/items/-', 'value': {'price': 3}},
+                                                       {'op': 'add', 'path': '/x-b', 'value': 1},
+                                                       {'op': 'test', 'path': '/id', 'value': 1}]))
+        data['items'].append({'price': 'x'})
+        self.assertFalse(revalidate(self.scheme, data, [{'op': 'add', 'path': '/items/-', 'value': {'price': 'x'}}]))
+        data['items'].pop()
+        data['items'][0]['price'] = 'x'
+        self.assertFalse(revalidate(self.scheme, data, [{'op': 'replace', 'path': '/items/0/price', 'value': 'x'}]))
+
+    def test_good_004(self):
+        """ removal that leaves only optional keys """
+        self.assertFalse(revalidate({Many(str): int}, {}, [('a',)]))
+        scheme = {Optional('a'): int, Many(re.compile('^x-')): int}
+        self.assertFalse(revalidate(scheme, {'a': 1}, [('x-b',)]))
+        self.assertTrue(revalidate(scheme, {'a': 1, 'x-a': 1}, [('x-b',)]))
+
+    def test_good_005(self):
+        """ alternatives that cannot take the item type """
+        self.assertFalse(revalidate([int, re.compile('^a')], [1.5], [(0,)]))
+        self.assertTrue(revalidate([int, re.compile('^a')], [1, 'ab'], [(1,)]))
+        for scheme in ([int, float], [int, str], [Text(), int], [int, object]):
+            for data in ([1, 2.0, 3], [1, 'a', u'b']):
+                self.assertEqual(revalidate(scheme, data, [(1,), (2,)]), validate(scheme, data))
+        self.assertTrue(revalidate([int, float], [1, 2.0], [(1,)]))
+        self.assertFalse(revalidate([int, float], [1, 'x'], [(1,)]))
+
+
+class LazyTestCase(unittest.TestCase):
+    def touch(self, view):
+        """ accesses every part of the view """
+        if hasattr(view, 'keys'):
+            return dict((key, self.touch(view[key])) for key in view)
+        if hasattr(view, '__getitem__') and not isinstance(view, basestring):
+            return [self.touch(item) for item in view]
+        return view
+
+    def test_good_001(self):
+        """ touching everything must agree with validate """
+        for scheme, data in CompileTestCase.samples:
+            try:
+                self.touch(lazy(scheme, data))
+            except ValidationError:
+                self.assertFalse(validate(scheme, data), (scheme, data))
+            else:
+                self.assertTrue(validate(scheme, data), (scheme, data))
+
+    def test_good_002(self):
+        checked = []
+        def price(value):
+            checked.append(value)
+            return type(value) is int
+        scheme = {'id': int, 'items': [{'price': price, Optional('name'): str}], Many(re.compile('^x-')): [int]}
+        data = {'id': 1, 'items': [{'price': i} for i in xrange(100)] + [{'price': 'x'}], 'x-a': [1], 'x-b': ['1']}
+        view = lazy(scheme, data)
+        self.assertEqual(view['items'][5]['price'], 5)
+        self.assertEqual(view['items'][-2], {'price': 99})
+        self.assertEqual(checked, [5, 99])
+        self.assertEqual(view['x-a'][0], 1)
+        self.assertTrue('x-b' in view)
+        self.assertEqual(len(view), 4)
+        self.assertRaises(ValidationError, lambda: view['x-b'][0])
+        self.assertRaises(ValidationError, lambda: view['items'][-1]['price'])
+        self.assertRaises(ValidationError, lambda: view['items'][-1]['price'])
+        self.assertEqual(checked, [5, 99, 'x'])
+        def assign():
+            view['id'] = 2
+        self.assertRaises(TypeError, assign)
+
+    def test_bad_001(self):
+        self.assertRaises(ValidationError, lazy, {'id': int}, {})
+        self.assertRaises(ValidationError, lazy, {'id': int}, [])
+        self.assertRaises(ValidationError, lazy, {'id': int}, {'id': 1, 'foo': 2})
+        self.assertRaises(ValidationError, lazy, [int], {})
+        self.assertRaises(ValidationError, lazy, int, '1')
+
+    def test_bad_002(self):
+        """ alternatives that cannot take the data type """
+        self.assertRaises(ValidationError, lazy, {Many(re.compile('^a')): []}, {1: 'b'})
+        self.assertRaises(ValidationError, lazy, {Optional(re.compile('^a')): int, 'b': int}, {1: 1, 'b': 1})
+        self.assertRaises(ValidationError, lazy, [int, re.compile('^a')], [1, 'ab', 1.5])
+
+
+class MemoTestCase(unittest.TestCase):
+    def test_good_001(self):
+        """ must agree with validate """
+        memo = Memo()
+        for i in xrange(2):
+            for scheme, data in CompileTestCase.samples:
+                self.assertEqual(validate(scheme, data, memo=memo), validate(scheme, data))
+
+    def test_good_002(self):
+        calls = []
+        @pure
+        def positive(x):
+            calls.append(x)
+            return x > 0
+        memo = Memo()
+        scheme = [{'point': (positive, positive), 'name': AnyOf(re.compile('^a'), None)}]
+        data = [{'point': (1, 2), 'name': 'ab'}, {'point': (1, 2), 'name': 'ab'}, {'point': (1.0, 2), 'name': None}]
+        self.assertTrue(validate(scheme, data, memo=memo))
+        self.assertEqual(calls, [1, 2, 1.0])
+        self.assertEqual((memo.hits, memo.misses), (3, 8))
+        self.assertFalse(validate(scheme, [{'point': (1, -2), 'name': 'b'}], memo=memo))
+        memo.clear()
+        self.assertEqual((memo.hits, memo.misses, len(memo.cache)), (0, 0, 0))
+
+    def test_good_003(self):
+        """ least recently used results are forgotten """
+        memo = Memo(size=2)
+        scheme = re.compile('^a')
+        for data in ['a', 'ab', 'a', 'abc', 'a', 'ab']:
+            validate(scheme, data, memo=memo)
+        self.assertEqual((memo.hits, memo.misses), (2, 4))
+
+    def test_bad_001(self):
+        """ impure callables are not remembered """
+        calls = []
+        def positive(x):
+            calls.append(x)
+            return x > 0
+        memo = Memo()
+        self.assertTrue(validate([(positive,)], [(1,), (1,)], memo=memo))
+        self.assertEqual(calls, [1, 1])
+        self.assertEqual(memo.misses, 0)
+
+
+class InternTestCase(unittest.TestCase):
+    def test_good_001(self):
+        """ validators made of equal parts are interned, but stay different dict keys """
+        for a, b in [(Many(str), Many(str)), (Optional({'a': [Text()]}), Optional({'a': [Text()]})),
+                     (AnyOf(1, re.compile('^a')), AnyOf(1, re.compile('^a'))),
+                     (Tagged('type', {'a': {'type': 'a'}}), Tagged('type', {'a': {'type': 'a'}}))]:
+            self.assertNotEqual(a, b)
+            first, second = intern([a, b])
+            self.assertTrue(first is second)
+        for a, b in [(Many(str), Optional(str)), (AnyOf(1), AnyOf(True)), (AnyOf(1), Scheme(1)),
+                     (Coerce(int, int), Coerce(int, float)), (Ref('a'), Ref('a'))]:
+            first, second = intern([a, b])
+            self.assertFalse(first is second)
+        self.assertTrue(validate({Many(str): int, Many(str): str}, {'a': 1, 'b': 'x'}))
+        self.assertEqual(len({Optional(str): int, Optional(str): int}), 2)
+        self.assertFalse(hasattr(Many(str), '__dict__'))
+        self.assertFalse(hasattr(Text(), '__dict__'))
+        namespace = {}
+        exec "from validol import *" in namespace
+        self.assertFalse('compile' in namespace or 'intern' in namespace)
+        self.assertTrue('validate' in namespace and 'Many' in namespace)
+
+    def test_good_002(self):
+        """ must agree with validate """
+        for scheme, data in CompileTestCase.samples:
+            self.assertEqual(validate(intern(scheme), data), validate(scheme, data))
+
+    def test_good_003(self):
+        entity = lambda: {'id': int, 'name': Text(), Optional('tags'): [AnyOf(str, None)]}
+        table = {}
+        first = intern({'users': [entity()], 'groups': [entity()]}, table)
+        second = intern([entity()], table)
+        self.assertTrue(first['users'][0] is first['groups'][0] is second[0])
+        self.assertTrue(first['users'] is first['groups'])
+        node = compile(first).node
+        self.assertTrue(node.literals['users'] is node.literals['groups'])
+        self.assertTrue(validate(first, {'users': [{'id': 1, 'name': u'foo'}], 'groups': []}))
+
+    def test_bad_001(self):
+        """ callables are compared by identity """
+        scheme = intern([(lambda x: x > 0,), (lambda x: x > 0,)])
+        self.assertFalse(scheme[0] is scheme[1])
+        tree = Define(Ref('node'), node={'value': int, Optional('children'): [Ref('node')]})
+        self.assertTrue(intern(tree) is tree)
+
+
+class ValidateIterativeTestCase(unittest.TestCase):
+    def test_good_001(self):
+        """ must agree with validate """
+        for scheme, data in CompileTestCase.samples:
+            self.assertEqual(validate_iterative(scheme, data), validate(scheme, data))
+
+    def test_good_002(self):
+        scheme = {'id': int, Optional('tags'): [str],
+                  'children': [Tagged('type', {'leaf': {'type': 'leaf', 'value': (int, Optional(str))}})]}
+        data = {'id': 1, 'children': [{'type': 'leaf', 'value': (1, None)}]}
+        self.assertTrue(validate_iterative(scheme, data))
+        data['children'][0]['value'] = (1, 2)
+        self.assertFalse(validate_iterative(scheme, data))
+        data['children'][0]['value'] = (1, 'a')
+        data['tags'] = ['a', 1]
+        self.assertFalse(validate_iterative(scheme, data))
+
+    def test_bad_001(self):
+        scheme = data = 1
+        for i in xrange(50):
+            scheme = {'next': scheme}
+            data = {'next': data}
+        self.assertTrue(validate_iterative(scheme, data))
+        self.assertFalse(validate_iterative(scheme, data, max_depth=49))
+
+    def test_bad_002(self):
+        """ deep data under Many keys, alternatives and AnyOf """
+        samples = [(Define(Ref('n'), n={Many(str): AnyOf(int, Ref('n'))}), {'a': 1}, {'a': 'x'},
+                    lambda data: {'a': data, 'b': 2}),
+                   (Define(Ref('n'), n=[int, Ref('n')]), [1], ['x'], lambda data: [1, data]),
+                   (Define(Ref('n'), n=AnyOf(None, [Ref('n')])), None, 1, lambda data: [data]),
+                   (Define(Ref('n'), n={Optional('a'): int, str: AnyOf(None, Ref('n'))}), {'b': None},
+                    {'b': 1}, lambda data: {'b': data})]
+        for scheme, good, bad, wrap in samples:
+            for i in xrange(5000):
+                good, bad = wrap(good), wrap(bad)
+            self.assertTrue(validate_iterative(scheme, good))
+            self.assertFalse(validate_iterative(scheme, bad))
+            self.assertFalse(validate_iterative(scheme, good, max_depth=1000))
+        # key 'a' may be taken by either validator, which is found out recursively
+        scheme = Define(Ref('n'), n={Many(str): AnyOf(None, Ref('n')), Many(re.compile('^a')): int})
+        data = None
+        for i in xrange(5000):
+            data = {'a': data}
+        self.assertRaises(TooDeep, validate_iterative, scheme, data)
+
+    def test_bad_003(self):
+        """ alternatives that take the same type are tried one after another """
+        for scheme, depth in [(Define(Ref('n'), n=AnyOf({'leaf': int}, {'kids': [Ref('n')]})), 20000),
+                              (Define(Ref('n'), n={'kids': [{'leaf': int}, Ref('n')]}), 5000)]:
+            good = {'kids': [{'leaf': 1}]}
+            bad = {'kids': [{'leaf': 'x'}]}
+            for i in xrange(depth):
+                good, bad = {'kids': [{'leaf': i}, good]}, {'kids': [{'leaf': i}, bad]}
+            self.assertTrue(validate_iterative(scheme, good))
+            self.assertFalse(validate_iterative(scheme, bad))
+        scheme = AnyOf({'a': int, 'b': [int]}, {'a': int, 'b': [str]}, {'a': str})
+        for data in [{'a': 1, 'b': [1]}, {'a': 1, 'b': ['x']}, {'a': 'x'}, {'a': 1, 'b': [1, 'x']}, {'a': 1}]:
+            self.assertEqual(validate_iterative(scheme, data), validate(scheme, data), data)
+
+
+class ValidateManyTestCase(unittest.TestCase):
+    scheme = {'id': lambda x: x >= 0, 'tags': [str]}
+    records = [{'id': i, 'tags': ['foo'] if i % 7 else [i]} for i in xrange(100)]
+
+    def test_good_001(self):
+        expected = [validate(self.scheme, record) for record in self.records]
+        for mode in ("process", "thread"):
+            result = validate_many(self.scheme, iter(self.records), workers=3, mode=mode, chunksize=8)
+            self.assertEqual(result, expected)
+        self.assertEqual(validate_many(self.scheme, self.records, workers=1), expected)
+
+    def test_good_002(self):
+        for workers in (1, 2):
+            result = validate_many(self.scheme, self.records, workers=workers, chunksize=10,
+                                   only_invalid=True)
+            self.assertEqual(result, range(0, 100, 7))
+
+    def test_bad_001(self):
+        self.assertRaises(ValueError, validate_many, int, [1], mode="foo")
+
+
+class ValidateStreamTestCase(unittest.TestCase):
+    def test_good_001(self):
+        items = [{'id': i, 'name': u'x' * (i % 50)} for i in xrange(500)]
+        items[123]['id'] = '123'
+        results = list(validate_stream([{'id': int, 'name': unicode}],
+                                       StringIO(json.dumps(items, indent=1)), buffer_size=7))
+        self.assertEqual(len(results), 500)
+        self.assertEqual([i for i, result in results if not result], [123])
+
+    def test_good_002(self):
+        """ numbers and literals split between reads """
+        results = validate_stream([int, None], StringIO(' [ 12345 ,\n null,678]  '), buffer_size=2)
+        self.assertEqual(list(results), [(0, True), (1, True), (2, True)])
+        self.assertEqual(list(validate_stream([int], StringIO('[]'))), [])
+        results = validate_stream([float], StringIO('[-1.5e-3, 2E+10]'), buffer_size=2)
+        self.assertEqual(list(results), [(0, True), (1, True)])
+
+    def test_good_003(self):
+        results = validate_stream([int], iter([1, 'a', 2]), fail_fast=True)
+        self.assertEqual(list(results), [(0, True), (1, False)])
+
+    def test_bad_001(self):
+        for text in ['{"a": 1}', '[1, 2', '[1 2]', '[1, tru]', '', '[1, 2] xxx', '[] 1']:
+            self.assertRaises(ValueError, list, validate_stream([int], StringIO(text), buffer_size=3))
+
+    def test_bad_002(self):
+        """ a malformed item is reported before the rest of the file is read """
+        source = StringIO('[1, {"a" 1}, ' + '2, ' * 100000 + '3]')
+        self.assertRaises(ValueError, list, validate_stream([int], source, buffer_size=64))
+        self.assertTrue(source.tell() < 1000)
+        results = validate_stream([int, re.compile('^a')], StringIO('[1, "ab", 1.5, "b"]'))
+        self.assertEqual(list(results), [(0, True), (1, True), (2, False), (3, False)])
+        self.assertEqual(list(validate_stream([int, Text()], [1, 'x', None])), [(0, True), (1, True), (2, False)])
+        self.assertEqual(list(validate_stream([int, float], StringIO('[1, 2.0] \n'))), [(0, True), (1, True)])
+
+
+class LoadsTestCase(unittest.TestCase):
+    scheme = {'id': int,
+              Optional('tags'): [Text()],
+              'items': [{'name': Text(), 'price': Optional(float)}],
+              'extra': {Many(Text()): int}}
+
+    def test_good_001(self):
+        for text in ['{"id": 1, "items": [], "extra": {"a": 0}}',
+                     ' { "items" : [ {"name": "a", "price": null}, {"price": 1.5, "name": "b"} ] ,'
+                     ' "tags": ["x"], "extra": {"a": 1, "b": 2}, "id": 7 } ']:
+            data = json.loads(text)
+            self.assertEqual(loads(self.scheme, text), data)
+            self.assertTrue(validate(self.scheme, data))
+
+    def test_bad_001(self):
+        for text, path in [('[]', ()),
+                           ('{"id": "1"', ('id',)),
+                           ('{"id": 1, "foo": 1', ('foo',)),
+                           ('{"id": 1, "items": [{"name": "a", "price": 1}', ('items', 0, 'price')),
+                           ('{"id": 1, "items": [], "extra": {"a": "b"}}', ('extra',)),
+                           ('{"id": 1, "items": []}', ())]:
+            try:
+                loads(self.scheme, text)
+            except ValidationError, e:
+                self.assertEqual(e.path, path)
+            else:
+                self.fail("%s must be invalid" % text)
+
+    def test_bad_002(self):
+        """ broken JSON """
+        for text in ['{"id": 1', '{"id": 1, "items": [], "extra": {}} 1', '{id: 1}']:
+            self.assertRaises(ValueError, loads, self.scheme, text)
+
+
+class CommandLineTestCase(unittest.TestCase):
+    scheme = {'id': int, 'name': Text()}
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.jsonl')
+        with os.fdopen(fd, 'w') as f:
+            for i in xrange(1000):
+                f.write(json.dumps({'id': i if i % 100 else str(i), 'name': 'foo'}) + '\n')
+            f.write('\n{"id": 1, "name": "foo"')
+        self.output = self.path + '.out'
+        self.stderr, sys.stderr = sys.stderr, StringIO()
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+        os.unlink(self.path)
+        if os.path.exists(self.output):
+            os.unlink(self.output)
+
+    def test_good_001(self):
+        expected = range(1, 1000, 100) + [1002]
+        for workers in ('1', '3'):
+            status = main(['tests:CommandLineTestCase.scheme', self.path,
+                           '--workers', workers, '--output', self.output])
+            self.assertEqual(status, 1)
+            with open(self.output) as f:
+                self.assertEqual(map(int, f), expected)
+        self.assertTrue(sys.stderr.getvalue().startswith("1002 lines, 11 invalid, "))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -15,8 +15,30 @@
 __version__ = "0.2" # XXX Not always updated :\
 __author__  = "Konstantin Merenkov <kmerenkov@gmail.com>"
 
+# compile and intern are left out, so that import * does not hide builtins
+__all__ = [
+    'TYPE_UNKNOWN', 'TYPE_VALIDATOR', 'TYPE_LIST', 'TYPE_REGEX', 'TYPE_TYPE', 'TYPE_DICTIONARY',
+    'TYPE_OBJECT', 'TYPE_TUPLE', 'TYPE_FUNCTION', 'ATOMIC_TYPES', 'CACHE_SIZE', 'MAX_DEPTH',
+    'ValidationError', 'format_path', 'kind_of', 'validate', 'validate_common', 'validate_tuple',
+    'validate_list', 'validate_hash', 'validate_hash_with_optional', 'validate_hash_with_many',
+    'BaseValidator', 'AnyOf', 'Many', 'Optional', 'Text', 'Scheme', 'Tagged', 'Ref', 'Define',
+    'Coerce', 'Default', 'Compiled', 'parse', 'revalidate', 'lazy', 'validate_detailed',
+    'validate_iterative', 'TooDeep', 'validate_many', 'validate_stream', 'loads', 'Profiler',
+    'LimitExceeded', 'Limits', 'Sample', 'Sampled', 'pure', 'Memo', 'main',
+    ]
 
-from itertools import imap
+
+from itertools import imap, islice, izip, repeat
+from collections import deque
+import collections
+import threading
+import math
+from timeit import default_timer
+import re
+import os
+import sys
+# argparse, json, mmap, multiprocessing and random are imported where they
+# are used: together they take ten times longer to import than the rest
 
 
 TYPE_UNKNOWN = 0
@@ -30,6 +52,29 @@ TYPE_TUPLE = 7
 TYPE_FUNCTION = 8
 
 ATOMIC_TYPES = set([str, unicode, int, bool, float])
+_TEXT_TYPES = frozenset([str, unicode])
+
+
+class ValidationError(ValueError):
+    """
+    Raised when data is found to be invalid by functions that return
+    something else than True or False. path is a tuple of keys and indices
+    leading to the invalid part of data. If known, expected is the part of
+    the scheme that did not accept actual, the part of data found at path.
+    """
+    def __init__(self, path=(), message="Invalid data", expected=None, actual=None):
+        ValueError.__init__(self, "%s at %s" % (message, format_path(path)))
+        self.path = tuple(path)
+        self.expected = expected
+        self.actual = actual
+
+
+def format_path(path):
+    """
+    >>> format_path(('items', 0, 'price'))
+    "$['items'][0]['price']"
+    """
+    return "$" + "".join("[%r]" % (part,) for part in path)
 
 
 class BaseValidator(object):
@@ -45,6 +90,20 @@ class BaseValidator(object):
     ...
     NotImplementedError: Inherit this class and override this method.
     """
+    __slots__ = ()
+
+    def __getstate__(self):
+        # validators with __slots__ have no __dict__ to be pickled
+        state = dict(getattr(self, '__dict__', ()))
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if hasattr(self, name):
+                    state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
 
     def validate(self, data):
         """
@@ -116,10 +175,17 @@ def kind_of(obj):
     else:
         return TYPE_UNKNOWN
 
-def validate(scheme, data):
+def validate(scheme, data, profiler=None, limits=None, sample=None, memo=None):
     """
     Validates data against scheme. Returns True if data
     found to be valid, False otherwise.
+    If profiler (see Profiler) is given, it records where the time goes.
+    If limits (see Limits) are given and data is too costly to check,
+    LimitExceeded is returned instead.
+    If sample (see Sample) is given, only some of the items of big lists
+    and dicts are checked. If memo (see Memo) is given, results for data
+    seen before are taken from it. Only one of these options can be used
+    at once.
 
     >>> validate(1, 1) # validate simple data
     True
@@ -131,7 +197,33 @@ def validate(scheme, data):
     False
     >>> validate(lambda x: x > 10, 20)
     True
+
+    Schemes used more than once are compiled (see compile) and the result
+    is cached by identity of the scheme. Changes to a dict or list scheme
+    itself are noticed, but do not modify parts nested in it once you
+    validated something against it.
     """
+    if [profiler, limits, sample, memo].count(None) < 3:
+        raise ValueError("only one of profiler, limits, sample and memo can be used at once")
+    if limits is not None:
+        return _validate_limited(scheme, data, limits)
+    if sample is not None:
+        return _validate_sampled(scheme, data, sample)
+    if profiler is not None:
+        return profiler.compile(scheme).check(data)
+    if memo is not None:
+        return memo.compile(scheme).check(data)
+    compiled = _lookup(_cache, scheme)
+    if compiled is not None:
+        return compiled.check(data)
+    # a scheme used only once (e.g. written right in the call) is not worth
+    # compiling, it is compiled when it comes again
+    # dicts are changed with single calls only, so validate is safe to call from threads
+    if _seen.pop(id(scheme), None) is scheme:
+        return _compiled(scheme).check(data)
+    if len(_seen) >= CACHE_SIZE:
+        _seen.clear()
+    _seen[id(scheme)] = scheme
     return validate_common(scheme, data)
 
 def validate_common(validator, data):
@@ -146,7 +238,7 @@ def validate_common(validator, data):
         except:
             return False
     elif kind == TYPE_REGEX:
-        if validator.match(data):
+        if isinstance(data, basestring) and validator.match(data):
             return True
     elif kind == TYPE_DICTIONARY:
         return validate_hash(validator, data)
@@ -190,10 +282,10 @@ def validate_list(validators, data):
     False
     >>> validate_list([str], ['foo'])
     True
-    >>> validate_list([str, str], ['foo'])
-    Traceback (most recent call last):
-    ...
-    NotImplementedError: You cannot specify more than one validator for list at the moment.
+    >>> validate_list([int, str], [1, 'foo', 2]) # every item matches any of validators
+    True
+    >>> validate_list([int, str], [1, 'foo', 2.0])
+    False
     """
     if type(data) is not list:
         return False
@@ -203,8 +295,10 @@ def validate_list(validators, data):
     elif n_validators == 1:
         validator = validators[0]
         return all(imap(lambda item: validate_common(validator, item), data))
-    elif n_validators > 1:
-        raise NotImplementedError("You cannot specify more than one validator for list at the moment.")
+    else:
+        return all(imap(lambda item: any(imap(lambda validator: validate_common(validator, item),
+                                              validators)),
+                        data))
 
 def validate_hash(validator, data):
     if type(data) is not dict:
@@ -213,16 +307,11 @@ def validate_hash(validator, data):
         return True
     if validator == {} and data != {}:
         return False
-    optional_validators = {}
-    many_validators = {}
-    for v_key, v_val in validator.iteritems():
-        if type(v_key) is Optional:
-            optional_validators[v_key] = v_val
-        else:
-            many_validators[v_key] = v_val
+    # both passes take validator as it is and skip keys of the other pass, since
+    # a dict built out of some of the keys may iterate them in another order
+    optional_validators = any(type(v_key) is Optional for v_key in validator)
     if optional_validators:
-        ret_with_optional, passed_optional_data_keys = validate_hash_with_optional(optional_validators,
-                                                                                   data)
+        ret_with_optional, passed_optional_data_keys = validate_hash_with_optional(validator, data)
         if not ret_with_optional: # optional validation has failed
             return False
     else:
@@ -234,23 +323,23 @@ def validate_hash(validator, data):
                                data.iteritems()))
     else:
         new_data = data
-    ret_with_many = validate_hash_with_many(many_validators, new_data)
+    ret_with_many = validate_hash_with_many(validator, new_data)
     return ret_with_many and ret_with_optional
 
 def validate_hash_with_optional(validator, data):
-    validator = dict(validator) # copy validator because later we modify it (pop keys out)
+    # plain keys go first, so Optional(str) can not take away the key of
+    # Optional('foo'); sort is stable, the rest keeps the order of the dict
+    validators = sorted((item for item in validator.iteritems() if type(item[0]) is Optional),
+                        key=lambda item: kind_of(item[0].data) != TYPE_UNKNOWN)
     valid_data_keys = set()
-    validator_count = len(validator)
-    used_validators_count = 0
     for data_key, data_value in data.iteritems():
-        for validator_key, validator_value in validator.iteritems():
+        for i, (validator_key, validator_value) in enumerate(validators):
             if validate_common(validator_key, data_key):
                 if validate_common(validator_value, data_value):
                     valid_data_keys.add(data_key)
-                    validator.pop(validator_key) # we don't need this validator in future
-                    used_validators_count += 1
+                    del validators[i] # we don't need this validator in future
                     # exhausted all optional validators, good sign
-                    if used_validators_count == validator_count:
+                    if not validators:
                         return (True, valid_data_keys)
                     break
                 else:
@@ -258,32 +347,81 @@ def validate_hash_with_optional(validator, data):
     return (True, valid_data_keys)
 
 def validate_hash_with_many(validator, data):
-    if validator != {} and data == {}:
+    # plain keys are looked up first, so Many(str) can not take away the
+    # key of 'foo', and every one of them must be used
+    literals = {}
+    others = []
+    for validator_key, validator_value in validator.iteritems():
+        if type(validator_key) is Optional:
+            continue
+        if kind_of(validator_key) == TYPE_UNKNOWN:
+            literals[validator_key] = validator_value
+        else:
+            others.append((validator_key, validator_value))
+    if (literals or others) and data == {}:
         return False
-    orig_validator = validator
-    copy_validator = dict(validator)
+    used_literals = 0
+    used = set() # indices of used validators that are not Many
     for data_key, data_value in data.iteritems():
-        data_valid = False
-        for validator_key, validator_value in copy_validator.iteritems():
+        if data_key in literals and validate_common(literals[data_key], data_value):
+            used_literals += 1
+            continue
+        for i, (validator_key, validator_value) in enumerate(others):
+            if i in used:
+                continue
             if validate_common(validator_key, data_key) and \
                     validate_common(validator_value, data_value):
                 if type(validator_key) is not Many:
-                    copy_validator.pop(validator_key)
-                data_valid = True
+                    used.add(i)
                 break
-        if not data_valid:
+        else:
             return False
-    # count Many validators
-    declared_many_validator_count = len(filter(lambda v: type(v) is Many,
-                                               orig_validator.keys()))
-    # count "unused" validators (Many validators aren't marked as used)
-    unused_notmany_validator_count = len(filter(lambda v: v in copy_validator,
-                                                orig_validator.keys()))
-    # their quantity must be equal for data to be proven valid
-    return unused_notmany_validator_count == declared_many_validator_count
+    n_once = len([1 for validator_key, validator_value in others if type(validator_key) is not Many])
+    # every plain key and every validator that is not Many must be used
+    return used_literals == len(literals) and len(used) == n_once
+
+
+class _Structural(BaseValidator):
+    """
+    Validator that tells its parts of scheme in _key, so that intern can
+    find validators made of equal parts (see _structure). The validators
+    themselves are still compared by identity: Many(str) used twice as a
+    dict key is two keys.
+    """
+    __slots__ = ()
+
+    def _key(self):
+        raise NotImplementedError("Inherit this class and override this method.")
+
+
+def _structure(scheme):
+    """
+    Returns hashable value that is equal for schemes that are made of equal
+    parts: values of the same type, the same types, callables and custom
+    validators (these are compared by identity) and so on.
+
+    >>> _structure({'id': int, 'tags': [Text()]}) == _structure({'tags': [Text()], 'id': int})
+    True
+    >>> _structure((1,)) == _structure((True,))
+    False
+    """
+    scheme_type = type(scheme)
+    if scheme_type is dict:
+        return (dict, frozenset((_structure(key), _structure(value)) for key, value in scheme.iteritems()))
+    elif isinstance(scheme, _Structural):
+        return (scheme_type, scheme._key())
+    elif scheme_type is list or scheme_type is tuple:
+        return (scheme_type, tuple(imap(_structure, scheme)))
+    elif kind_of(scheme) == TYPE_REGEX:
+        return (scheme_type, scheme.pattern, scheme.flags)
+    try:
+        hash(scheme)
+    except TypeError:
+        return (scheme_type, id(scheme))
+    return (scheme_type, scheme)
 
 
-class AnyOf(BaseValidator):
+class AnyOf(_Structural):
     """
     Validates if data matches at least one of specified schemes.
 
@@ -294,18 +432,47 @@ class AnyOf(BaseValidator):
     >>> AnyOf(1, 2, 3).validate(10)
     False
     """
+    __slots__ = ('validators', 'values', 'atomic_types', 'others')
+
     def __init__(self, *validators):
         self.validators = validators
+        # Plain values and types are checked with a single set lookup,
+        # only the rest has to be tried one by one.
+        values = []
+        atomic_types = []
+        others = []
+        for validator in validators:
+            kind = kind_of(validator)
+            if kind == TYPE_TYPE:
+                atomic_types.append(validator)
+            elif kind == TYPE_UNKNOWN and getattr(validator, '__hash__', None) is not None:
+                values.append(validator)
+            else:
+                others.append(validator)
+        self.values = frozenset(values)
+        self.atomic_types = frozenset(atomic_types)
+        self.others = tuple(others)
 
     def validate(self, data):
         """ returns True if data is valid for at least one validator. """
-        return any(imap(lambda validator: validate_common(validator, data), self.validators))
+        if type(data) in self.atomic_types:
+            return True
+        if self.values:
+            try:
+                if data in self.values:
+                    return True
+            except TypeError: # data is not hashable
+                pass
+        return any(imap(lambda validator: validate_common(validator, data), self.others))
+
+    def _key(self):
+        return tuple(imap(_structure, self.validators))
 
     def __str__(self):
         return "<AnyOf: '%s'>" % str(self.validators)
 
 
-class Many(BaseValidator):
+class Many(_Structural):
     """
     BIG FAT WARNING: Useful only for dict validation. In fact all it does is simple
     1-to-1 comparison, i.e. same as validate(X, X)  where X is some exact value.
@@ -315,17 +482,22 @@ class Many(BaseValidator):
     >>> Many('foo').validate('foo')
     True
     """
+    __slots__ = ('data',)
+
     def __init__(self, data):
         self.data = data
 
     def validate(self, data):
         return validate_common(self.data, data)
 
+    def _key(self):
+        return _structure(self.data)
+
     def __str__(self):
         return "<Many: '%s'>" % str(self.data)
 
 
-class Optional(BaseValidator):
+class Optional(_Structural):
     """
     When used as a key for hash, validates data if data matches scheme or if key is absent from hash.
     When used anywhere else, validates data if data is None or if data is valid.
@@ -337,27 +509,36 @@ class Optional(BaseValidator):
     >>> Optional('foo').validate('bar')
     False
     """
+    __slots__ = ('data',)
+
     def __init__(self, data):
         self.data = data
 
     def validate(self, data):
         return data is None or validate_common(self.data, data)
 
+    def _key(self):
+        return _structure(self.data)
+
     def __str__(self):
         return "<Optional: '%s'>" % str(self.data)
 
 
-class Text(BaseValidator):
+class Text(_Structural):
     """
     Passes on any textual data (be it str or unicode).
     """
+    __slots__ = ()
+
     def __init__(self):
         pass
 
     def validate(self, data):
         # I could do isinstance(data, basestring) but I remember it to be slow.
-        # Not sure if the code below is any faster :)
-        return AnyOf(str, unicode).validate(data)
+        return type(data) in _TEXT_TYPES
+
+    def _key(self):
+        return ()
 
 
 class Scheme(AnyOf):
@@ -366,10 +547,3029 @@ class Scheme(AnyOf):
     Often it is useful, often it is not - depends on your needs.
     Behaves exactly as AnyOf, except has different str and repr methods.
     """
+    __slots__ = ()
+
     def __str__(self):
         return "<Scheme: '%s'>" % str(self.validators)
 
 
+class Tagged(_Structural):
+    """
+    Validates dicts that tell what they are in one of their keys. Value of
+    that key picks the scheme the whole dict is validated against, so
+    schemes have to mention the key too.
+    Unlike AnyOf, only one scheme is ever tried.
+
+    >>> shape = Tagged('type', {'point': {'type': 'point', 'x': int},
+    ...                         'line': {'type': 'line', 'x': int, 'len': int}})
+    >>> shape.validate({'type': 'point', 'x': 10})
+    True
+    >>> shape.validate({'type': 'point', 'x': 10, 'len': 2})
+    False
+    >>> shape.validate({'type': 'circle', 'x': 10})
+    False
+    """
+    __slots__ = ('key', 'schemes')
+
+    def __init__(self, key, schemes):
+        self.key = key
+        self.schemes = schemes
+
+    def validate(self, data):
+        if type(data) is not dict:
+            return False
+        try:
+            scheme = self.schemes[data[self.key]]
+        except (KeyError, TypeError): # TypeError comes from unhashable tags
+            return False
+        return validate_common(scheme, data)
+
+    def _key(self):
+        return (_structure(self.key), _structure(self.schemes))
+
+    def __str__(self):
+        return "<Tagged: '%s' %s>" % (self.key, str(self.schemes))
+
+
+class Ref(BaseValidator):
+    """
+    Stands for a scheme named in Define, see there.
+    Refs and Defines are equal only to themselves.
+    """
+    __slots__ = ('name', 'scheme')
+
+    def __init__(self, name):
+        self.name = name
+        self.scheme = None # set by Define
+
+    def validate(self, data):
+        if self.scheme is None:
+            raise ValueError("Unresolved reference: %r" % (self.name,))
+        return validate_common(self.scheme, data)
+
+    def __str__(self):
+        return "<Ref: '%s'>" % self.name
+
+
+class Define(BaseValidator):
+    """
+    Validates data against scheme, where Ref(name) stands for the scheme
+    given as keyword argument name. Schemes may refer to themselves and each
+    other, so recursive structures can be described:
+
+    >>> tree = Define(Ref('node'), node={'value': int, 'children': [Ref('node')]})
+    >>> tree.validate({'value': 1, 'children': [{'value': 2, 'children': []}]})
+    True
+    >>> tree.validate({'value': 1, 'children': [{'value': 2}]})
+    False
+
+    Nested Define may use names of the outer one, unless it defines them
+    itself.
+    """
+    __slots__ = ('scheme', 'definitions')
+
+    def __init__(self, scheme, **definitions):
+        self.scheme = scheme
+        self.definitions = definitions
+        seen = set()
+        for root in [scheme] + definitions.values():
+            _bind_refs(root, definitions, seen)
+
+    def validate(self, data):
+        return validate_common(self.scheme, data)
+
+    def __str__(self):
+        return "<Define: '%s' %s>" % (str(self.scheme), str(self.definitions))
+
+
+class Coerce(_Structural):
+    """
+    Validates data that matches target, or that fn turns into something
+    that matches target. parse returns what fn returned, validate only
+    tells if it would work.
+
+    >>> Coerce(int, int).validate('10')
+    True
+    >>> Coerce(int, int).validate('foo')
+    False
+    >>> parse({'id': Coerce(int, int)}, {'id': '10'})
+    {'id': 10}
+    """
+    __slots__ = ('target', 'fn')
+
+    def __init__(self, target, fn):
+        self.target = target
+        self.fn = fn
+
+    def validate(self, data):
+        if validate_common(self.target, data):
+            return True
+        try:
+            data = self.fn(data)
+        except Exception:
+            return False
+        return validate_common(self.target, data)
+
+    def _key(self):
+        return (_structure(self.target), self.fn)
+
+    def __str__(self):
+        return "<Coerce: '%s'>" % str(self.target)
+
+
+class Default(_Structural):
+    """
+    Validates data against scheme. When used as a value of an Optional
+    plain key, parse puts value under the key if it is absent.
+    value is used as it is, not copied.
+
+    >>> parse({Optional('limit'): Default(10, int)}, {})
+    {'limit': 10}
+    """
+    __slots__ = ('value', 'scheme')
+
+    def __init__(self, value, scheme=object):
+        self.value = value
+        self.scheme = scheme
+
+    def validate(self, data):
+        return validate_common(self.scheme, data)
+
+    def _key(self):
+        return (_structure(self.value), _structure(self.scheme))
+
+    def __str__(self):
+        return "<Default: %r '%s'>" % (self.value, str(self.scheme))
+
+
+def intern(scheme, table=None):
+    """
+    Returns scheme where parts that are made of equal parts (see
+    _structure) are the same object, so they take memory and get compiled
+    only once. Pass the same table (a dict) to share parts between schemes.
+    Refs, Defines and what they refer to are left as they are.
+
+    >>> scheme = intern([{'id': int, 'name': Text()}, {'id': int, 'name': Text()}])
+    >>> scheme[0] is scheme[1]
+    True
+    """
+    if table is None:
+        table = {}
+    scheme_type = type(scheme)
+    if scheme_type is dict:
+        scheme = dict((intern(key, table), intern(value, table)) for key, value in scheme.iteritems())
+    elif scheme_type is list or scheme_type is tuple:
+        scheme = scheme_type(intern(item, table) for item in scheme)
+    elif scheme_type is AnyOf or scheme_type is Scheme:
+        scheme = scheme_type(*[intern(validator, table) for validator in scheme.validators])
+    elif scheme_type is Many or scheme_type is Optional:
+        scheme = scheme_type(intern(scheme.data, table))
+    elif scheme_type is Tagged:
+        scheme = Tagged(scheme.key, intern(scheme.schemes, table))
+    elif scheme_type is Coerce:
+        scheme = Coerce(intern(scheme.target, table), scheme.fn)
+    elif scheme_type is Default:
+        scheme = Default(scheme.value, intern(scheme.scheme, table))
+    return table.setdefault(_structure(scheme), scheme)
+
+
+def _bind_refs(scheme, definitions, seen):
+    """ Points every unbound Ref found in scheme to its definition. """
+    stack = [scheme]
+    while stack:
+        scheme = stack.pop()
+        if id(scheme) in seen:
+            continue
+        seen.add(id(scheme))
+        scheme_type = type(scheme)
+        if scheme_type is Ref:
+            if scheme.scheme is None and scheme.name in definitions:
+                scheme.scheme = definitions[scheme.name]
+        elif scheme_type is dict:
+            stack.extend(scheme.iterkeys())
+            stack.extend(scheme.itervalues())
+        elif scheme_type is list or scheme_type is tuple:
+            stack.extend(scheme)
+        elif scheme_type is AnyOf or scheme_type is Scheme:
+            stack.extend(scheme.validators)
+        elif scheme_type is Many or scheme_type is Optional:
+            stack.append(scheme.data)
+        elif scheme_type is Tagged:
+            stack.extend(scheme.schemes.itervalues())
+        elif scheme_type is Define:
+            stack.append(scheme.scheme)
+            stack.extend(scheme.definitions.itervalues())
+        elif scheme_type is Coerce:
+            stack.append(scheme.target)
+        elif scheme_type is Default:
+            stack.append(scheme.scheme)
+
+
+### Compiled validators ###
+# validate_common walks the scheme every time it is called and asks kind_of
+# about every element of it. compile() does the walk once and resolves every
+# element into a node with a dedicated check method, so validation itself
+# is just a chain of calls.
+
+class _Node(object):
+    """
+    Compiled form of a single element of a scheme.
+
+    types is a set of exact types of data the node can possibly accept,
+    or None if it cannot tell. If exact is true, the type of data is
+    all the node looks at. converts is true if parse may return something
+    else than data, i.e. there is Coerce or Default somewhere inside.
+    """
+    __slots__ = ('scheme', 'check', 'types', 'exact', 'converts')
+
+    def __init__(self, scheme):
+        self.scheme = scheme
+        self.check = self.validate
+        self.types = None
+        self.exact = False
+        self.converts = False
+
+    def validate(self, data):
+        raise NotImplementedError("Inherit this class and override this method.")
+
+    def split(self, data):
+        """
+        Used by validate_iterative instead of recursion. Returns True or
+        False if the node can tell right away, otherwise (node, data) pairs
+        that all have to be valid, or None if the node has to be checked
+        with check.
+        """
+        return None
+
+    def explain(self, data, path, errors):
+        """
+        Used by validate_detailed once check failed. Tells errors (see
+        _Errors) what is wrong with data, by default data as a whole.
+        """
+        errors.add(path, self.scheme, data)
+
+    def convert(self, data, path):
+        """
+        Used by parse. Returns data converted as the scheme says, or data
+        itself if nothing changed. Raises ValidationError if data is invalid.
+        """
+        if self.check(data):
+            return data
+        raise ValidationError(path, expected=self.scheme, actual=data)
+
+    def revalidate(self, data, path):
+        """
+        Used by revalidate. data used to be valid and only its part at path
+        (keys and indices relative to data) has changed since. Returns True
+        if data is still valid. By default checks data as a whole.
+        """
+        return self.check(data)
+
+    def lazy(self, data, path):
+        """
+        Used by lazy. Returns data if it is valid, or a proxy that checks
+        parts of data when they are accessed. Raises ValidationError if
+        data is found to be invalid. By default checks data as a whole.
+        """
+        if self.check(data):
+            return data
+        raise ValidationError(path, expected=self.scheme, actual=data)
+
+    def __repr__(self):
+        return "<%s: %r>" % (self.__class__.__name__.lstrip('_'), self.scheme)
+
+
+class _ObjectNode(_Node):
+    __slots__ = ()
+
+    def validate(self, data):
+        return True
+
+
+class _TypeNode(_Node):
+    __slots__ = ()
+
+    def __init__(self, scheme):
+        _Node.__init__(self, scheme)
+        self.types = frozenset([scheme])
+        self.exact = True
+
+    def validate(self, data):
+        return type(data) is self.scheme
+
+
+def _value_types(value):
+    """ Types of data that may be equal to value, None if it can be anything. """
+    # numbers are equal to Decimal, Fraction, ... and strings to their subclasses
+    if value is None:
+        return frozenset([type(None)])
+    return None
+
+class _ValueNode(_Node):
+    __slots__ = ()
+
+    def __init__(self, scheme):
+        _Node.__init__(self, scheme)
+        self.types = _value_types(scheme)
+
+    def validate(self, data):
+        return data == self.scheme
+
+
+class _RegexNode(_Node):
+    __slots__ = ('match',)
+
+    def __init__(self, scheme):
+        _Node.__init__(self, scheme)
+        self.match = scheme.match # subclasses of str and unicode are matched too, so no types
+
+    def validate(self, data):
+        return isinstance(data, basestring) and self.match(data) is not None
+
+
+class _FunctionNode(_Node):
+    __slots__ = ()
+
+    def validate(self, data):
+        try:
+            if self.scheme(data):
+                return True
+        except:
+            pass
+        return False
+
+
+class _ValidatorNode(_Node):
+    """ Any validator we know nothing about, asked through its validate method. """
+    __slots__ = ()
+
+    def validate(self, data):
+        if self.scheme.validate(data):
+            return True
+        return False
+
+
+class _AnyOfNode(_Node):
+    """ Partitioned the same way as AnyOf itself. """
+    __slots__ = ('values', 'atomic_types', 'nodes')
+
+    def __init__(self, scheme, values, atomic_types, nodes):
+        _Node.__init__(self, scheme)
+        self.values = values
+        self.atomic_types = atomic_types
+        self.nodes = nodes
+        types = _union_types(nodes)
+        for value in values:
+            if types is None:
+                break
+            value_types = _value_types(value)
+            types = types | value_types if value_types is not None else None
+        if types is not None:
+            self.types = types | atomic_types
+            self.exact = not values and all(node.exact for node in nodes)
+        self.converts = any(node.converts for node in nodes)
+
+    def validate(self, data):
+        if type(data) in self.atomic_types:
+            return True
+        if self.values:
+            try:
+                if data in self.values:
+                    return True
+            except TypeError:
+                pass
+        for node in self.nodes:
+            if node.check(data):
+                return True
+        return False
+
+    def split(self, data):
+        if type(data) in self.atomic_types:
+            return True
+        if self.values:
+            try:
+                if data in self.values:
+                    return True
+            except TypeError:
+                pass
+        nodes = [node for node in self.nodes if node.types is None or type(data) in node.types]
+        if len(nodes) == 1:
+            return ((nodes[0], data),)
+        return bool(nodes) and _Choice((node, data) for node in nodes)
+
+    def convert(self, data, path):
+        if not self.converts or type(data) in self.atomic_types:
+            return _Node.convert(self, data, path)
+        if self.values:
+            try:
+                if data in self.values:
+                    return data
+            except TypeError:
+                pass
+        for node in self.nodes:
+            try:
+                return node.convert(data, path)
+            except ValidationError:
+                pass
+        raise ValidationError(path, expected=self.scheme, actual=data)
+
+
+class _TaggedNode(_Node):
+    __slots__ = ('key', 'nodes')
+
+    def __init__(self, scheme, key, nodes):
+        _Node.__init__(self, scheme)
+        self.key = key
+        self.nodes = nodes # {tag: node}
+        self.types = frozenset([dict])
+        self.converts = any(node.converts for node in nodes.itervalues())
+
+    def validate(self, data):
+        if type(data) is not dict:
+            return False
+        try:
+            node = self.nodes.get(data.get(self.key, _missing))
+        except TypeError:
+            return False
+        return node is not None and node.check(data)
+
+    def split(self, data):
+        if type(data) is not dict:
+            return False
+        try:
+            node = self.nodes.get(data.get(self.key, _missing))
+        except TypeError:
+            return False
+        return node is not None and ((node, data),)
+
+    def explain(self, data, path, errors):
+        if type(data) is not dict:
+            return errors.add(path, self.scheme, data)
+        tag = data.get(self.key, _missing)
+        try:
+            node = self.nodes.get(tag)
+        except TypeError:
+            node = None
+        if node is None:
+            if tag is _missing:
+                return errors.add(path + (self.key,), self.scheme, None, "Missing key")
+            return errors.add(path + (self.key,), self.scheme, tag, "Unknown tag")
+        node.explain(data, path, errors)
+
+    def convert(self, data, path):
+        if not self.converts or type(data) is not dict:
+            return _Node.convert(self, data, path)
+        try:
+            node = self.nodes.get(data.get(self.key, _missing))
+        except TypeError:
+            node = None
+        if node is None:
+            raise ValidationError(path, expected=self.scheme, actual=data)
+        return node.convert(data, path)
+
+    def revalidate(self, data, path):
+        if not path or path[0] == self.key or type(data) is not dict:
+            return self.check(data)
+        node = self.nodes.get(data.get(self.key, _missing))
+        return node is not None and node.revalidate(data, path)
+
+    def lazy(self, data, path):
+        if type(data) is not dict:
+            return _Node.lazy(self, data, path)
+        try:
+            node = self.nodes.get(data.get(self.key, _missing))
+        except TypeError:
+            node = None
+        if node is None:
+            raise ValidationError(path + (self.key,), "Unknown tag", self.scheme, data.get(self.key))
+        return node.lazy(data, path)
+
+_missing = object()
+
+
+class _RefNode(_Node):
+    """
+    Compiled Ref, node is set once the referenced scheme is compiled.
+    Whether that scheme converts is not known yet, so it is assumed to.
+    """
+    __slots__ = ('node',)
+
+    def __init__(self, scheme):
+        _Node.__init__(self, scheme)
+        self.converts = True
+
+    def validate(self, data):
+        return self.node.check(data)
+
+    def split(self, data):
+        return ((self.node, data),)
+
+    def explain(self, data, path, errors):
+        self.node.explain(data, path, errors)
+
+    def convert(self, data, path):
+        return self.node.convert(data, path)
+
+    def revalidate(self, data, path):
+        return self.node.revalidate(data, path)
+
+    def lazy(self, data, path):
+        return self.node.lazy(data, path)
+
+
+class _OptionalNode(_Node):
+    __slots__ = ('node',)
+
+    def __init__(self, scheme, node):
+        _Node.__init__(self, scheme)
+        self.node = node
+        if node.types is not None:
+            self.types = node.types | frozenset([type(None)])
+            self.exact = node.exact
+        self.converts = node.converts
+
+    def validate(self, data):
+        return data is None or self.node.check(data)
+
+    def split(self, data):
+        return data is None or ((self.node, data),)
+
+    def explain(self, data, path, errors):
+        self.node.explain(data, path, errors)
+
+    def convert(self, data, path):
+        if data is None:
+            return data
+        return self.node.convert(data, path)
+
+    def revalidate(self, data, path):
+        return data is None or self.node.revalidate(data, path)
+
+    def lazy(self, data, path):
+        if data is None:
+            return data
+        return self.node.lazy(data, path)
+
+
+class _ManyNode(_Node):
+    __slots__ = ('node',)
+
+    def __init__(self, scheme, node):
+        _Node.__init__(self, scheme)
+        self.node = node
+        self.check = node.check
+        self.types = node.types
+        self.exact = node.exact
+        self.converts = node.converts
+
+    def split(self, data):
+        return ((self.node, data),)
+
+    def explain(self, data, path, errors):
+        self.node.explain(data, path, errors)
+
+    def convert(self, data, path):
+        return self.node.convert(data, path)
+
+    def revalidate(self, data, path):
+        return self.node.revalidate(data, path)
+
+    def lazy(self, data, path):
+        return self.node.lazy(data, path)
+
+
+class _CoerceNode(_Node):
+    __slots__ = ('node', 'fn')
+
+    def __init__(self, scheme, node):
+        _Node.__init__(self, scheme)
+        self.node = node
+        self.fn = scheme.fn
+        self.converts = True
+
+    def validate(self, data):
+        if self.node.check(data):
+            return True
+        try:
+            data = self.fn(data)
+        except Exception:
+            return False
+        return self.node.check(data)
+
+    def convert(self, data, path):
+        try:
+            return self.node.convert(data, path)
+        except ValidationError:
+            pass
+        try:
+            converted = self.fn(data)
+        except Exception:
+            raise ValidationError(path, expected=self.scheme, actual=data)
+        return self.node.convert(converted, path)
+
+
+class _DefaultNode(_Node):
+    """ Checks data with its node, dicts look for it to fill absent keys. """
+    __slots__ = ('node',)
+
+    def __init__(self, scheme, node):
+        _Node.__init__(self, scheme)
+        self.node = node
+        self.check = node.check
+        self.types = node.types
+        self.exact = node.exact
+        self.converts = True
+
+    def explain(self, data, path, errors):
+        self.node.explain(data, path, errors)
+
+    def convert(self, data, path):
+        return self.node.convert(data, path)
+
+    def revalidate(self, data, path):
+        return self.node.revalidate(data, path)
+
+    def lazy(self, data, path):
+        return self.node.lazy(data, path)
+
+
+class _TextNode(_Node):
+    __slots__ = ()
+
+    def __init__(self, scheme):
+        _Node.__init__(self, scheme)
+        self.types = _TEXT_TYPES
+        self.exact = True
+
+    def validate(self, data):
+        return type(data) is str or type(data) is unicode
+
+
+class _TupleNode(_Node):
+    """
+    Tuples of types and tuples of plain values are compared as a whole,
+    without checking items one by one.
+    """
+    __slots__ = ('nodes', 'expected')
+
+    def __init__(self, scheme, nodes):
+        _Node.__init__(self, scheme)
+        self.nodes = nodes
+        self.types = frozenset([tuple])
+        if all(node.exact and len(node.types) == 1 for node in nodes):
+            self.expected = tuple(iter(node.types).next() for node in nodes)
+            self.check = self.validate_types
+        elif all(type(node) is _ValueNode for node in nodes):
+            self.check = self.validate_values
+        self.converts = any(node.converts for node in nodes)
+
+    def validate(self, data):
+        if type(data) is not tuple or len(data) != len(self.nodes):
+            return False
+        for node, item in zip(self.nodes, data):
+            if not node.check(item):
+                return False
+        return True
+
+    def validate_types(self, data):
+        return type(data) is tuple and len(data) == len(self.expected) and \
+            tuple(imap(type, data)) == self.expected
+
+    def validate_values(self, data):
+        return type(data) is tuple and data == self.scheme
+
+    def split(self, data):
+        if self.check != self.validate:
+            return self.check(data)
+        if type(data) is not tuple or len(data) != len(self.nodes):
+            return False
+        return izip(self.nodes, data)
+
+    def explain(self, data, path, errors):
+        if type(data) is not tuple or len(data) != len(self.nodes):
+            return errors.add(path, self.scheme, data)
+        for i, (node, item) in enumerate(izip(self.nodes, data)):
+            errors.check(node, item, path + (i,))
+
+    def convert(self, data, path):
+        if not self.converts:
+            return _Node.convert(self, data, path)
+        if type(data) is not tuple or len(data) != len(self.nodes):
+            raise ValidationError(path, expected=self.scheme, actual=data)
+        result = data
+        for i, (node, item) in enumerate(izip(self.nodes, data)):
+            converted = node.convert(item, path + (i,))
+            if converted is not item:
+                if result is data:
+                    result = list(data)
+                result[i] = converted
+        return result if result is data else tuple(result)
+
+    def revalidate(self, data, path):
+        if not path or type(data) is not tuple or len(data) != len(self.nodes) or \
+                type(path[0]) is not int or not 0 <= path[0] < len(data):
+            return self.check(data)
+        return self.nodes[path[0]].revalidate(data[path[0]], path[1:])
+
+
+class _ListNode(_Node):
+    """
+    Lists of items that are checked by type alone (or by equality to a plain
+    value) are validated in bulk, without calling a check for every item.
+    With several validators, every item is tried only against validators
+    that can accept its type, see _candidates.
+    """
+    __slots__ = ('nodes', 'expected', 'by_type')
+
+    def __init__(self, scheme, nodes):
+        _Node.__init__(self, scheme)
+        self.nodes = nodes
+        self.types = frozenset([list])
+        self.by_type = {} # {type of item: True if the type is enough, or [checks]}
+        if any(type(node) is _ObjectNode for node in nodes):
+            self.check = self.validate_anything
+        elif len(nodes) > 1:
+            if all(node.exact for node in nodes):
+                self.expected = _union_types(nodes)
+                self.check = self.validate_types
+            else:
+                self.check = self.validate_alternatives
+        elif len(nodes) == 1:
+            node = nodes[0]
+            if type(node) is _ObjectNode:
+                self.check = self.validate_anything
+            elif node.exact:
+                self.expected = node.types
+                self.check = self.validate_types
+            elif type(node) is _ValueNode:
+                self.expected = node.scheme
+                self.check = self.validate_values
+        self.converts = any(node.converts for node in nodes)
+
+    def validate_anything(self, data):
+        return type(data) is list
+
+    def validate_types(self, data):
+        """
+        Types are checked in chunks of doubling size, so a list that is
+        invalid from the start is not scanned to the end.
+        """
+        if type(data) is not list:
+            return False
+        issuperset = self.expected.issuperset
+        start, size = 0, 64
+        while start + size < len(data):
+            if not issuperset(imap(type, data[start:start + size])):
+                return False
+            start += size
+            size *= 2
+        return issuperset(imap(type, data[start:] if start else data))
+
+    def validate_values(self, data):
+        return type(data) is list and data.count(self.expected) == len(data)
+
+    def _candidates(self, item_type):
+        candidates = []
+        for node in self.nodes:
+            if node.types is None or item_type in node.types:
+                if node.exact:
+                    candidates = True
+                    break
+                candidates.append(node.check)
+        self.by_type[item_type] = candidates
+        return candidates
+
+    def check_item(self, item):
+        """ Whether one item matches any of alternatives. """
+        candidates = self.by_type.get(type(item))
+        if candidates is None:
+            candidates = self._candidates(type(item))
+        return candidates is True or any(check(item) for check in candidates)
+
+    def validate_alternatives(self, data):
+        if type(data) is not list:
+            return False
+        by_type = self.by_type
+        for item in data:
+            candidates = by_type.get(type(item))
+            if candidates is None:
+                candidates = self._candidates(type(item))
+            if candidates is True:
+                continue
+            for check in candidates:
+                if check(item):
+                    break
+            else:
+                return False
+        return True
+
+    def split(self, data):
+        if self.check == self.validate_alternatives:
+            return self.split_alternatives(data)
+        if self.check != self.validate:
+            return self.check(data)
+        if type(data) is not list:
+            return False
+        if not self.nodes:
+            return len(data) == 0
+        return izip(repeat(self.nodes[0]), data)
+
+    def split_alternatives(self, data):
+        """ Items are left to alternatives that can take their type, see _AnyOfNode.split. """
+        if type(data) is not list:
+            return False
+        pairs = []
+        by_type = {} # {type of item: True if the type is enough, False if nothing takes it, or node}
+        for item in data:
+            node = by_type.get(type(item))
+            if node is None:
+                nodes = [node for node in self.nodes if node.types is None or type(item) in node.types]
+                if any(node.exact for node in nodes):
+                    node = True
+                elif len(nodes) == 1:
+                    node = nodes[0]
+                elif nodes:
+                    node = _AnyOfNode(self.scheme, (), frozenset(), nodes)
+                else:
+                    node = False
+                by_type[type(item)] = node
+            if node is False:
+                return False
+            if node is not True:
+                pairs.append((node, item))
+        return pairs
+
+    def explain(self, data, path, errors):
+        if type(data) is not list or not self.nodes:
+            return errors.add(path, self.scheme, data)
+        for i, item in enumerate(data):
+            if len(self.nodes) == 1:
+                errors.check(self.nodes[0], item, path + (i,))
+            elif not self.check_item(item):
+                errors.add(path + (i,), self.scheme, item)
+
+    def convert(self, data, path):
+        if not self.converts:
+            return _Node.convert(self, data, path)
+        if type(data) is not list:
+            raise ValidationError(path, expected=self.scheme, actual=data)
+        result = data
+        for i, item in enumerate(data):
+            converted = _convert_any(self.nodes, item, path + (i,))
+            if converted is not item:
+                if result is data:
+                    result = list(data)
+                result[i] = converted
+        return result
+
+    def revalidate(self, data, path):
+        """ Items do not depend on each other, so only the changed one is checked. """
+        if not path or type(data) is not list or not self.nodes or type(path[0]) is not int:
+            return self.check(data)
+        if not 0 <= path[0] < len(data):
+            return True # removed from the end
+        item = data[path[0]]
+        if len(self.nodes) == 1:
+            return self.nodes[0].revalidate(item, path[1:])
+        return self.check_item(item)
+
+    def lazy(self, data, path):
+        """ Items are left to _LazyList, unless they are checked in bulk anyway. """
+        if self.check != self.validate:
+            return _Node.lazy(self, data, path)
+        if type(data) is not list:
+            raise ValidationError(path, expected=self.scheme, actual=data)
+        if not self.nodes:
+            return _Node.lazy(self, data, path)
+        return _LazyList(data, self, path)
+
+    def validate(self, data):
+        if type(data) is not list:
+            return False
+        if not self.nodes:
+            return len(data) == 0
+        for item in data:
+            for node in self.nodes:
+                if node.check(item):
+                    break
+            else:
+                return False
+        return True
+
+
+class _DictNode(_Node):
+    """
+    Same two passes as validate_hash: Optional keys go first, then everything
+    else, where Many keys may be used any number of times and other keys
+    exactly once. Plain values used as keys (optional or not) are looked up
+    in a dict instead of being tried one by one, and keys taken by Optional
+    validators are remembered in a set rather than removed from a copy
+    of data. Other keys are tried only if they can accept the type of
+    data key, see _candidates.
+    """
+    __slots__ = ('optional_literals', 'optional', 'literals', 'required',
+                 'n_once', 'by_type', 'plain')
+
+    def __init__(self, scheme, optional_literals, optional, literals, required):
+        _Node.__init__(self, scheme)
+        self.optional_literals = optional_literals # {key: value node}
+        self.optional = optional # [(key node, value node)]
+        self.literals = literals # {key: value node}
+        self.required = required # [(index, is Many, key node, value node)]
+        self.n_once = len([1 for i, is_many, key, value in required if not is_many])
+        self.by_type = {} # {type of data key: candidates out of required}
+        self.types = frozenset([dict])
+        self.converts = any(node.converts for node in optional_literals.itervalues()) or \
+            any(value.converts for key, value in optional) or \
+            any(node.converts for node in literals.itervalues()) or \
+            any(value.converts for i, is_many, key, value in required)
+        # every key is a plain value and each of them is either optional or not,
+        # so every data key has exactly one validator for its value
+        self.plain = not optional and not required and \
+            not any(key in literals for key in optional_literals)
+
+    def split(self, data):
+        if type(data) is not dict:
+            return False
+        if not self.plain:
+            try:
+                values = self._assign(data, ())
+            except ValidationError:
+                return False
+            if values is None:
+                return None # values tell which validator takes a key
+            return ((values[key], value) for key, value in data.iteritems())
+        literals = self.literals
+        optional_literals = self.optional_literals
+        n_literals = 0
+        for key in data:
+            if key in literals:
+                n_literals += 1
+            elif key not in optional_literals:
+                return False
+        if n_literals != len(literals):
+            return False
+        return ((literals.get(key) or optional_literals[key], value)
+                for key, value in data.iteritems())
+
+    def _candidates(self, key_type):
+        candidates = [validator for validator in self.required
+                      if validator[2].types is None or key_type in validator[2].types]
+        self.by_type[key_type] = candidates
+        return candidates
+
+    def validate(self, data):
+        if type(data) is not dict:
+            return False
+        literals = self.literals
+        if not (self.optional_literals or self.optional or literals or self.required):
+            return not data
+        used_keys = _no_keys
+        if self.optional_literals:
+            used_keys = set()
+            if len(self.optional_literals) <= len(data):
+                for key, value in self.optional_literals.iteritems():
+                    if key in data:
+                        if not value.check(data[key]):
+                            return False
+                        used_keys.add(key)
+            else:
+                get_value = self.optional_literals.get
+                for d_key, d_value in data.iteritems():
+                    value = get_value(d_key)
+                    if value is not None:
+                        if not value.check(d_value):
+                            return False
+                        used_keys.add(d_key)
+        if self.optional:
+            if not used_keys:
+                used_keys = set()
+            validators = list(self.optional)
+            for d_key, d_value in data.iteritems():
+                if d_key in used_keys:
+                    continue
+                for i, (key, value) in enumerate(validators):
+                    if key.check(d_key):
+                        if not value.check(d_value):
+                            return False
+                        used_keys.add(d_key)
+                        del validators[i]
+                        break
+                if not validators:
+                    break
+        if (literals or self.required) and len(used_keys) == len(data):
+            return False
+        by_type = self.by_type
+        used = set() if self.n_once else _no_keys
+        used_literals = 0
+        for d_key, d_value in data.iteritems():
+            if used_keys and d_key in used_keys:
+                continue
+            value = literals.get(d_key)
+            if value is not None and value.check(d_value):
+                used_literals += 1
+                continue
+            candidates = by_type.get(type(d_key))
+            if candidates is None:
+                candidates = self._candidates(type(d_key))
+            for i, is_many, key, value in candidates:
+                if not is_many and i in used:
+                    continue
+                if key.check(d_key) and value.check(d_value):
+                    if not is_many:
+                        used.add(i)
+                    break
+            else:
+                return False
+        return used_literals == len(literals) and len(used) == self.n_once
+
+    def explain(self, data, path, errors):
+        """
+        Finds validators that can take every key of data, and explains the
+        value with the first of them if none of them takes the value.
+        """
+        if type(data) is not dict:
+            return errors.add(path, self.scheme, data)
+        found = len(errors)
+        used = set()
+        for d_key, d_value in data.iteritems():
+            values = [] # [(index of required key or None, value node)]
+            for literals in (self.literals, self.optional_literals):
+                try:
+                    if d_key in literals:
+                        values.append((None, literals[d_key]))
+                except TypeError:
+                    pass
+            required = self.by_type.get(type(d_key))
+            if required is None:
+                required = self._candidates(type(d_key))
+            values.extend((None, value) for key, value in self.optional if _accepts(key, d_key))
+            values.extend((None if is_many else i, value) for i, is_many, key, value in required
+                          if i not in used and key.check(d_key))
+            for i, value in values:
+                if value.check(d_value):
+                    if i is not None:
+                        used.add(i)
+                    break
+            else:
+                if values:
+                    i, value = values[0]
+                    if i is not None:
+                        used.add(i)
+                    value.explain(d_value, path + (d_key,), errors)
+                else:
+                    errors.add(path + (d_key,), self.scheme, d_value, "Unexpected key")
+        for key, value in self.literals.iteritems():
+            if key not in data:
+                errors.add(path + (key,), value.scheme, None, "Missing key")
+        for i, is_many, key, value in self.required:
+            if not is_many and i not in used:
+                errors.add(path, key.scheme, data, "Missing key")
+        if len(errors) == found:
+            errors.add(path, self.scheme, data)
+
+    def convert(self, data, path):
+        """
+        Keys are taken in the same order as in validate: by plain Optional
+        keys, Optional validators, plain keys and then the rest. Once a key
+        is taken, its value must be valid for the validator that took it;
+        only the rest may be tried one after another.
+        """
+        if not self.converts:
+            return _Node.convert(self, data, path)
+        if type(data) is not dict:
+            raise ValidationError(path, expected=self.scheme, actual=data)
+        result = data
+        used = set()
+        used_keys = set() # taken by Optional
+        optional = list(self.optional)
+        for d_key, d_value in data.iteritems():
+            d_path = path + (d_key,)
+            try:
+                value = self.optional_literals.get(d_key)
+            except TypeError:
+                value = None
+            if value is None:
+                for j, (key, node) in enumerate(optional):
+                    if _accepts(key, d_key):
+                        value = node
+                        del optional[j]
+                        break
+            if value is not None:
+                used_keys.add(d_key)
+            else:
+                try:
+                    value = self.literals.get(d_key)
+                except TypeError:
+                    pass
+            if value is not None:
+                converted = value.convert(d_value, d_path)
+            else:
+                error = None
+                for i, is_many, key, node in self.required:
+                    if i in used or not key.check(d_key):
+                        continue
+                    try:
+                        converted = node.convert(d_value, d_path)
+                    except ValidationError, e:
+                        error = error or e
+                        continue
+                    if not is_many:
+                        used.add(i)
+                    break
+                else:
+                    raise error or ValidationError(d_path, "Unexpected key", self.scheme, d_value)
+            if converted is not d_value:
+                if result is data:
+                    result = dict(data)
+                result[d_key] = converted
+        for key, value in self.literals.iteritems():
+            if key not in data or key in used_keys:
+                raise ValidationError(path + (key,), "Missing key", value.scheme)
+        for i, is_many, key, value in self.required:
+            if not is_many and i not in used:
+                raise ValidationError(path, "Missing key", key.scheme, data)
+        if (self.literals or self.required) and len(used_keys) == len(data):
+            raise ValidationError(path, "Missing key", self.scheme, data)
+        for key, value in self.optional_literals.iteritems():
+            if type(value) is _DefaultNode and key not in data:
+                if result is data:
+                    result = dict(data)
+                result[key] = value.scheme.value
+        return result
+
+    def revalidate(self, data, path):
+        """
+        If only one validator can take the changed key, the rest of data
+        is not affected, unless the validator can be used only once and
+        may have been taken by another key.
+        """
+        if not path or type(data) is not dict:
+            return self.check(data)
+        key = path[0]
+        try:
+            present = key in data
+        except TypeError:
+            return self.check(data)
+        matching = self._matching(key)
+        if len(matching) != 1:
+            return not matching and not present or self.check(data)
+        kind, slot, value = matching[0]
+        if slot is not None:
+            return self.check(data)
+        if not present:
+            if kind == "literal":
+                return False
+            # without plain keys, a key that is not optional must be left;
+            # if there are fewer keys than optional validators, look closer
+            if self.required and not self.literals and \
+                    len(data) <= len(self.optional_literals) + len(self.optional):
+                return self.check(data)
+            return True
+        return value.revalidate(data[key], path[1:])
+
+    def lazy(self, data, path):
+        """
+        Keys are checked right away, values are left to _LazyDict. If any
+        key can be taken by several validators, data is checked as a whole.
+        """
+        if type(data) is not dict:
+            raise ValidationError(path, expected=self.scheme, actual=data)
+        values = self._assign(data, path)
+        if values is None:
+            return _Node.lazy(self, data, path)
+        return _LazyDict(data, values, path)
+
+    def _assign(self, data, path):
+        """
+        Checks keys of data and returns {key: value node}, or None if some
+        key can be taken by several validators, so values have to be checked
+        to tell which one. Raises ValidationError for keys that do not fit.
+        """
+        values = {}
+        slots = set()
+        n_optional = 0
+        for key in data:
+            matching = self._matching(key)
+            if not matching:
+                raise ValidationError(path + (key,), "Unexpected key", self.scheme, data[key])
+            if len(matching) != 1:
+                return None
+            kind, slot, value = matching[0]
+            if slot is not None:
+                if slot in slots:
+                    return None
+                slots.add(slot)
+            n_optional += kind == "optional"
+            values[key] = value
+        for key, value in self.literals.iteritems():
+            if key not in data:
+                raise ValidationError(path + (key,), "Missing key", value.scheme)
+        if len([1 for kind, i in slots if kind == "once"]) != self.n_once or \
+                (self.literals or self.required) and n_optional == len(data):
+            raise ValidationError(path, "Missing key", self.scheme, data)
+        return values
+
+    def _matching(self, key):
+        """
+        Returns [(kind, slot, value node)] for every validator that can
+        take key, where kind is "literal", "optional", "many" or "once".
+        Validators that can be used only once have a slot to tell them apart.
+        """
+        matching = []
+        if key in self.literals:
+            matching.append(("literal", None, self.literals[key]))
+        if key in self.optional_literals:
+            matching.append(("optional", None, self.optional_literals[key]))
+        matching.extend(("optional", ("optional", j), value) for j, (key_node, value) in enumerate(self.optional)
+                        if _accepts(key_node, key))
+        required = self.by_type.get(type(key))
+        if required is None:
+            required = self._candidates(type(key))
+        matching.extend(("many", None, value) if is_many else ("once", ("once", i), value)
+                        for i, is_many, key_node, value in required if key_node.check(key))
+        return matching
+
+_no_keys = frozenset()
+
+
+def _accepts(node, data):
+    """ Checks data with node, unless node cannot take data of its type. """
+    return (node.types is None or type(data) in node.types) and node.check(data)
+
+
+def _convert_any(nodes, data, path):
+    """ Converts data with the first of nodes that accepts it. """
+    if len(nodes) == 1:
+        return nodes[0].convert(data, path)
+    error = None
+    for node in nodes:
+        try:
+            return node.convert(data, path)
+        except ValidationError, e:
+            error = error or e
+    raise error
+
+
+class _Compiler(object):
+    """
+    Turns a scheme into a tree of nodes. Every scheme object is compiled
+    only once, so parts of the scheme that are shared stay shared.
+
+    Every node is compiled for a path, which tells where in the scheme the
+    node is, e.g. ("['items']", '[*]', "['price']"). If wrap is given, it is
+    called as wrap(node, path) for every node and its result is used instead
+    of the node. Wrapped nodes are not shared between paths.
+    """
+    def __init__(self, wrap=None):
+        self.nodes = {}
+        self.refs = {}
+        self.wrap = wrap
+
+    def compile(self, scheme, path=(), wrap=True):
+        key = id(scheme) if self.wrap is None else (id(scheme), path, wrap)
+        try:
+            return self.nodes[key][1]
+        except KeyError:
+            pass
+        kind = kind_of(scheme)
+        if kind == TYPE_VALIDATOR:
+            build = _validator_compilers.get(type(scheme))
+            if build is None:
+                node = _ValidatorNode(scheme)
+            else:
+                node = build(self, scheme, path)
+        else:
+            node = self.builders[kind](self, scheme, path)
+        if self.wrap is not None and wrap:
+            node = self.wrap(node, path)
+        # keep the scheme alive, otherwise its id may be taken by someone else
+        self.nodes[key] = (scheme, node)
+        return node
+
+    def compile_ref(self, ref, path):
+        """
+        All Refs to the same scheme share one node, which is registered
+        before the scheme is compiled, so recursion stops at it.
+        """
+        if ref.scheme is None:
+            raise ValueError("Unresolved reference: %r" % (ref.name,))
+        try:
+            return self.refs[id(ref.scheme)]
+        except KeyError:
+            pass
+        node = self.refs[id(ref.scheme)] = _RefNode(ref)
+        node.node = self.compile(ref.scheme, path)
+        return node
+
+    def compile_dict(self, scheme, path):
+        optional_literals = {}
+        optional = []
+        literals = {}
+        required = []
+        for key, value in scheme.iteritems():
+            if type(key) is Optional:
+                if kind_of(key.data) == TYPE_UNKNOWN:
+                    optional_literals[key.data] = self.compile(value, path + ("[%r]" % (key.data,),))
+                else:
+                    optional.append((self.compile(key, path + ("{%s}" % _label(key),)),
+                                     self.compile(value, path + ("[%s]" % _label(key),))))
+            elif kind_of(key) == TYPE_UNKNOWN:
+                literals[key] = self.compile(value, path + ("[%r]" % (key,),))
+            else:
+                required.append((len(required), type(key) is Many,
+                                 self.compile(key, path + ("{%s}" % _label(key),)),
+                                 self.compile(value, path + ("[%s]" % _label(key),))))
+        return _DictNode(scheme, optional_literals, optional, literals, required)
+
+    def compile_list(self, scheme, path):
+        if len(scheme) == 1:
+            return _ListNode(scheme, [self.compile(scheme[0], path + ("[*]",))])
+        return _ListNode(scheme, [self.compile(item, path + ("[*]|%d" % i,))
+                                  for i, item in enumerate(scheme)])
+
+    def compile_tuple(self, scheme, path):
+        return _TupleNode(scheme, [self.compile(item, path + ("[%d]" % i,))
+                                   for i, item in enumerate(scheme)])
+
+    builders = {
+        TYPE_UNKNOWN: lambda self, scheme, path: _ValueNode(scheme),
+        TYPE_OBJECT: lambda self, scheme, path: _ObjectNode(scheme),
+        TYPE_TYPE: lambda self, scheme, path: _TypeNode(scheme),
+        TYPE_REGEX: lambda self, scheme, path: _RegexNode(scheme),
+        TYPE_FUNCTION: lambda self, scheme, path: _FunctionNode(scheme),
+        TYPE_DICTIONARY: compile_dict,
+        TYPE_LIST: compile_list,
+        TYPE_TUPLE: compile_tuple,
+        }
+
+
+def _label(scheme):
+    """ Short human readable name of a scheme, used in paths. """
+    kind = kind_of(scheme)
+    if kind == TYPE_TYPE or kind == TYPE_OBJECT:
+        return scheme.__name__
+    elif kind == TYPE_REGEX:
+        return "/%s/" % scheme.pattern
+    elif kind == TYPE_FUNCTION:
+        return getattr(scheme, '__name__', 'function')
+    elif type(scheme) is Many or type(scheme) is Optional:
+        return "%s(%s)" % (type(scheme).__name__, _label(scheme.data))
+    elif kind == TYPE_VALIDATOR:
+        return type(scheme).__name__
+    return repr(scheme)
+
+
+def _union_types(nodes):
+    types = frozenset()
+    for node in nodes:
+        if node.types is None:
+            return None
+        types |= node.types
+    return types
+
+
+def _find_tag(schemes):
+    """
+    Finds a key that all schemes have and that holds a distinct plain value
+    in every scheme, i.e. a key that tells which scheme data may match.
+    Returns (key, {value: scheme}) or None.
+    """
+    if len(schemes) < 2:
+        return None
+    for scheme in schemes:
+        if type(scheme) is not dict:
+            return None
+    for key in schemes[0]:
+        if kind_of(key) != TYPE_UNKNOWN:
+            continue
+        tags = {}
+        for scheme in schemes:
+            if key not in scheme or kind_of(scheme[key]) != TYPE_UNKNOWN:
+                break
+            try:
+                tags[scheme[key]] = scheme
+            except TypeError:
+                break
+        else:
+            if len(tags) == len(schemes):
+                return key, tags
+    return None
+
+def _compile_tags(compiler, validator, key, schemes, path):
+    return _TaggedNode(validator, key, dict((value, compiler.compile(scheme, path + ("|%r" % (value,),)))
+                                            for value, scheme in schemes.iteritems()))
+
+def _compile_any_of(compiler, validator, path):
+    tag = _find_tag(validator.validators)
+    if tag is not None:
+        key, schemes = tag
+        return _compile_tags(compiler, validator, key, schemes, path)
+    return _AnyOfNode(validator, validator.values, validator.atomic_types,
+                      [compiler.compile(other, path + ("|%d" % i,))
+                       for i, other in enumerate(validator.others)])
+
+
+# Many and Optional share path with what they wrap, so only the outer
+# node is wrapped.
+_validator_compilers = {
+    AnyOf: _compile_any_of,
+    Scheme: _compile_any_of,
+    Tagged: lambda compiler, v, path: _compile_tags(compiler, v, v.key, v.schemes, path),
+    Many: lambda compiler, v, path: _ManyNode(v, compiler.compile(v.data, path, wrap=False)),
+    Optional: lambda compiler, v, path: _OptionalNode(v, compiler.compile(v.data, path, wrap=False)),
+    Text: lambda compiler, v, path: _TextNode(v),
+    Ref: lambda compiler, v, path: compiler.compile_ref(v, path),
+    Define: lambda compiler, v, path: compiler.compile(v.scheme, path, wrap=False),
+    Coerce: lambda compiler, v, path: _CoerceNode(v, compiler.compile(v.target, path, wrap=False)),
+    Default: lambda compiler, v, path: _DefaultNode(v, compiler.compile(v.scheme, path, wrap=False)),
+    }
+
+
+### Code generation ###
+# The other way to compile a scheme: instead of a tree of nodes, generate
+# source of a single function with checks, loops and key lookups written
+# out, and exec it. Nodes that are not worth writing out (callables, custom
+# validators, dicts with Many or type keys, ...) are called from the
+# generated function as they are.
+
+class _CodeGen(object):
+    MAX_BLOCKS = 16 # python refuses to nest more than 20 loops and trys
+    MAX_UNROLL = 32 # longer tuples are checked by their node
+    MAX_INDENT = 64 # python refuses to indent more than 100 levels
+
+    def __init__(self):
+        self.lines = []
+        self.constants = []
+        self.names = {}
+        self.n_vars = 0
+
+    def source(self, node):
+        self.lines.append("def validate(v0):")
+        self.node(node, "v0", 1, 0)
+        self.lines.append("    return True")
+        names = ", ".join(["imap", "missing"] + [name for name, value in self.constants])
+        header = "def make(%s):" % names
+        body = ["    " + line for line in self.lines]
+        return "\n".join([header] + body + ["    return validate", ""])
+
+    def build(self, node):
+        source = self.source(node)
+        namespace = {}
+        exec source in namespace
+        values = [value for name, value in self.constants]
+        return namespace['make'](imap, _missing, *values), source
+
+    def const(self, value, prefix="c"):
+        """ Binds value to a name the generated function can use. """
+        key = (prefix, id(value))
+        if key not in self.names:
+            name = "%s%d" % (prefix, len(self.constants))
+            self.names[key] = name
+            self.constants.append((name, value))
+        return self.names[key]
+
+    def var(self):
+        self.n_vars += 1
+        return "v%d" % self.n_vars
+
+    def emit(self, indent, line):
+        self.lines.append("    " * indent + line)
+
+    def fail_unless(self, indent, condition):
+        self.emit(indent, "if not (%s): return False" % condition)
+
+    def literal(self, value):
+        if type(value) in (str, unicode, int, long, bool) or value is None:
+            return repr(value)
+        return self.const(value, "k")
+
+    def node(self, node, var, indent, blocks):
+        generate = self.generators.get(type(node)) if indent < self.MAX_INDENT else None
+        if generate is None or not generate(self, node, var, indent, blocks):
+            self.fail_unless(indent, "%s(%s)" % (self.const(node.check), var))
+
+    def block(self, header, node, var, indent, blocks):
+        """ Emits header with code for node under it, or nothing if node needs no code. """
+        start = len(self.lines)
+        self.emit(indent, header)
+        self.node(node, var, indent + 1, blocks)
+        if len(self.lines) == start + 1:
+            del self.lines[start:]
+
+    def object_node(self, node, var, indent, blocks):
+        return True
+
+    def type_node(self, node, var, indent, blocks):
+        self.fail_unless(indent, "type(%s) is %s" % (var, self.const(node.scheme, "t")))
+        return True
+
+    def exact_node(self, node, var, indent, blocks):
+        if not node.exact:
+            return False
+        self.fail_unless(indent, "type(%s) in %s" % (var, self.const(node.types, "t")))
+        return True
+
+    def value_node(self, node, var, indent, blocks):
+        self.fail_unless(indent, "%s == %s" % (var, self.literal(node.scheme)))
+        return True
+
+    def regex_node(self, node, var, indent, blocks):
+        self.fail_unless(indent, "isinstance(%s, basestring) and %s(%s) is not None" %
+                         (var, self.const(node.match, "r"), var))
+        return True
+
+    def function_node(self, node, var, indent, blocks):
+        if blocks >= self.MAX_BLOCKS:
+            return False
+        result = self.var()
+        self.emit(indent, "try:")
+        self.emit(indent + 1, "%s = %s(%s)" % (result, self.const(node.scheme, "f"), var))
+        self.emit(indent, "except:")
+        self.emit(indent + 1, "return False")
+        self.fail_unless(indent, result)
+        return True
+
+    def optional_node(self, node, var, indent, blocks):
+        if self.exact_node(node, var, indent, blocks):
+            return True
+        self.block("if %s is not None:" % var, node.node, var, indent, blocks)
+        return True
+
+    def many_node(self, node, var, indent, blocks):
+        self.node(node.node, var, indent, blocks)
+        return True
+
+    def tuple_node(self, node, var, indent, blocks):
+        if len(node.nodes) > self.MAX_UNROLL:
+            return False
+        self.fail_unless(indent, "type(%s) is tuple and len(%s) == %d" % (var, var, len(node.nodes)))
+        for i, item in enumerate(node.nodes):
+            item_var = self.var()
+            self.emit(indent, "%s = %s[%d]" % (item_var, var, i))
+            self.node(item, item_var, indent, blocks)
+        return True
+
+    def list_node(self, node, var, indent, blocks):
+        self.fail_unless(indent, "type(%s) is list" % var)
+        if node.check == node.validate_anything:
+            pass
+        elif node.check == node.validate_types:
+            self.fail_unless(indent, "%s(%s)" % (self.const(node.validate_types), var))
+        elif node.check == node.validate_values:
+            self.fail_unless(indent, "%s.count(%s) == len(%s)" % (var, self.literal(node.expected), var))
+        elif not node.nodes:
+            self.fail_unless(indent, "not %s" % var)
+        elif len(node.nodes) == 1 and blocks < self.MAX_BLOCKS:
+            item_var = self.var()
+            self.block("for %s in %s:" % (item_var, var), node.nodes[0], item_var, indent, blocks + 1)
+        else:
+            self.fail_unless(indent, "%s(%s)" % (self.const(node.check), var))
+        return True
+
+    def dict_node(self, node, var, indent, blocks):
+        if not node.plain:
+            return False
+        self.fail_unless(indent, "type(%s) is dict" % var)
+        if not node.literals and not node.optional_literals:
+            self.fail_unless(indent, "not %s" % var)
+            return True
+        size = None
+        if node.optional_literals:
+            size = self.var()
+            self.emit(indent, "%s = %d" % (size, len(node.literals)))
+        for key, value in node.literals.iteritems():
+            item_var = self.var()
+            self.emit(indent, "%s = %s.get(%s, missing)" % (item_var, var, self.literal(key)))
+            self.fail_unless(indent, "%s is not missing" % item_var)
+            self.node(value, item_var, indent, blocks)
+        for key, value in node.optional_literals.iteritems():
+            item_var = self.var()
+            self.emit(indent, "%s = %s.get(%s, missing)" % (item_var, var, self.literal(key)))
+            self.emit(indent, "if %s is not missing:" % item_var)
+            self.emit(indent + 1, "%s += 1" % size)
+            self.node(value, item_var, indent + 1, blocks)
+        self.fail_unless(indent, "len(%s) == %s" % (var, size or len(node.literals)))
+        return True
+
+    generators = {
+        _ObjectNode: object_node,
+        _TypeNode: type_node,
+        _TextNode: exact_node,
+        _AnyOfNode: exact_node,
+        _ValueNode: value_node,
+        _RegexNode: regex_node,
+        _FunctionNode: function_node,
+        _OptionalNode: optional_node,
+        _ManyNode: many_node,
+        _TupleNode: tuple_node,
+        _ListNode: list_node,
+        _DictNode: dict_node,
+        }
+
+
+class Compiled(object):
+    """
+    Scheme turned into a validator, see compile.
+    For the "codegen" backend source holds the generated code.
+    """
+    def __init__(self, scheme, node, check=None, source=None):
+        self.scheme = scheme
+        self.node = node
+        self.check = check or node.check
+        self.source = source
+
+    def __call__(self, data):
+        return self.check(data)
+
+    def __repr__(self):
+        return "<Compiled: %r>" % (self.scheme,)
+
+
+def compile(scheme, backend="tree"):
+    """
+    Walks scheme once and returns callable that validates data against it.
+    Use it if you validate a lot of data against the same scheme.
+
+    With backend="codegen" validation is done by a single generated
+    function, its source is kept in the source attribute.
+
+    >>> is_valid = compile({'id': int, Optional('name'): str})
+    >>> is_valid({'id': 1})
+    True
+    >>> is_valid({'id': 1, 'name': 10})
+    False
+    >>> is_valid = compile({'id': int, Optional('name'): str}, backend="codegen")
+    >>> is_valid({'id': 1, 'name': 10})
+    False
+    """
+    node = _Compiler().compile(scheme)
+    if backend == "tree":
+        return Compiled(scheme, node)
+    elif backend == "codegen":
+        check, source = _CodeGen().build(node)
+        return Compiled(scheme, node, check, source)
+    raise ValueError("Unknown backend: %r" % (backend,))
+
+
+CACHE_SIZE = 1024
+# Caches are keyed by identity of the scheme and keep the scheme itself, so
+# that its id is not taken by someone else. Dicts and lists are also kept
+# as a shallow copy, to notice when they were changed.
+_cache = {} # {id(scheme): [scheme, copy, compiled scheme, used lately]}
+_seen = {} # {id(scheme): scheme} validated once by validate_common
+
+def _snapshot(scheme):
+    if type(scheme) is dict:
+        return dict(scheme)
+    elif type(scheme) is list:
+        return list(scheme)
+    return None
+
+def _lookup(cache, scheme):
+    """ Returns what cache has for scheme, None if nothing or if scheme was changed since. """
+    entry = cache.get(id(scheme))
+    if entry is None:
+        return None
+    if entry[1] is not None and entry[1] != scheme:
+        cache.pop(id(scheme), None)
+        return None
+    entry[3] = True
+    return entry[2]
+
+def _store(cache, scheme, value):
+    if len(cache) >= CACHE_SIZE:
+        _evict(cache)
+    cache[id(scheme)] = [scheme, _snapshot(scheme), value, True]
+
+def _evict(cache):
+    """
+    Forgets schemes that were not used since the last eviction. If all of
+    them were, forgets a half of them.
+    """
+    for key, entry in cache.items():
+        if entry[3]:
+            entry[3] = False
+        else:
+            cache.pop(key, None)
+    if len(cache) >= CACHE_SIZE:
+        for key in cache.keys()[:CACHE_SIZE // 2]:
+            cache.pop(key, None)
+
+def _compiled(scheme):
+    """ Returns compiled scheme from the cache used by validate. """
+    compiled = _lookup(_cache, scheme)
+    if compiled is None:
+        compiled = compile(scheme)
+        _store(_cache, scheme, compiled)
+    return compiled
+
+def _compiled_with(cache, scheme, wrap):
+    """ Same as _compiled, but returns tree of nodes wrapped by wrap. """
+    node = _lookup(cache, scheme)
+    if node is None:
+        node = _Compiler(wrap).compile(scheme)
+        _store(cache, scheme, node)
+    return node
+
+
+### Parsing ###
+
+def parse(scheme, data):
+    """
+    Validates data against scheme and converts it as Coerce and Default
+    parts of the scheme say, in a single walk. Returns converted data,
+    where containers are copied only if something inside them changed,
+    everything else is data itself. Raises ValidationError if data is
+    invalid.
+
+    >>> data = {'id': '1', 'tags': ['foo']}
+    >>> result = parse({'id': Coerce(int, int), 'tags': [str], Optional('limit'): Default(10, int)}, data)
+    >>> result == {'id': 1, 'tags': ['foo'], 'limit': 10}, result['tags'] is data['tags']
+    (True, True)
+    >>> parse({'id': Coerce(int, int)}, {'id': 'foo'})
+    Traceback (most recent call last):
+    ...
+    ValidationError: Invalid data at $['id']
+    """
+    return _compiled(scheme).node.convert(data, ())
+
+
+### Incremental validation ###
+
+def revalidate(scheme, data, changes):
+    """
+    Tells if data is still valid after a change, given it was valid before.
+    Only parts of data that were changed, and the containers they are in
+    if they care, are checked again. changes are paths (tuples of keys and
+    indices) of the changed parts, or JSON Patch operations. data must
+    already have the changes applied.
+
+    >>> scheme = {'items': [{'price': int}], 'owner': {'name': str}}
+    >>> data = {'items': [{'price': 1}] * 1000, 'owner': {'name': 'foo'}}
+    >>> data['items'][10] = {'price': '2'}
+    >>> revalidate(scheme, data, [('items', 10)])
+    False
+    >>> data['items'][10] = {'price': 2}
+    >>> revalidate(scheme, data, [{'op': 'replace', 'path': '/items/10', 'value': {'price': 2}}])
+    True
+    >>> del data['owner']['name']
+    >>> revalidate(scheme, data, [('owner', 'name')])
+    False
+    """
+    node = _compiled(scheme).node
+    for change in changes:
+        if type(change) is dict:
+            paths = [_pointer_path(data, change[name]) for name in ('from', 'path')
+                     if name in change and change['op'] != 'test']
+        else:
+            paths = [tuple(change)]
+        for path in paths:
+            if not node.revalidate(data, path):
+                return False
+    return True
+
+def _pointer_path(data, pointer):
+    """
+    Turns JSON Pointer into a path, indices of lists found in data
+    become ints.
+
+    >>> _pointer_path({'a': [{'b/c': 1}]}, '/a/0/b~1c')
+    ('a', 0, 'b/c')
+    """
+    path = []
+    for part in pointer.split('/')[1:]:
+        part = part.replace('~1', '/').replace('~0', '~')
+        if type(data) is list:
+            part = len(data) - 1 if part == '-' else int(part) # data has the item appended
+            data = data[part] if 0 <= part < len(data) else None
+        elif type(data) is dict:
+            data = data.get(part)
+        path.append(part)
+    return tuple(path)
+
+
+### Lazy validation ###
+
+class _LazyDict(collections.Mapping):
+    """
+    Read-only view of a dict, every value is checked (and turned into
+    a lazy view itself) the first time it is accessed.
+    """
+    def __init__(self, data, nodes, path):
+        self.data = data
+        self.nodes = nodes # {key: value node}
+        self.path = path
+        self.checked = {} # {key: value or ValidationError}
+
+    def __getitem__(self, key):
+        try:
+            value = self.checked[key]
+        except KeyError:
+            try:
+                value = self.nodes[key].lazy(self.data[key], self.path + (key,))
+            except ValidationError, e:
+                value = e
+            self.checked[key] = value
+        if type(value) is ValidationError:
+            raise value
+        return value
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return "<lazy %r>" % (self.data,)
+
+
+class _LazyList(collections.Sequence):
+    """ Read-only view of a list, see _LazyDict. """
+    def __init__(self, data, node, path):
+        self.data = data
+        self.node = node
+        self.path = path
+        self.checked = {} # {index: item or ValidationError}
+
+    def __getitem__(self, index):
+        if type(index) is slice:
+            return [self[i] for i in xrange(*index.indices(len(self.data)))]
+        if index < 0:
+            index += len(self.data)
+        try:
+            item = self.checked[index]
+        except KeyError:
+            item = self.data[index]
+            path = self.path + (index,)
+            try:
+                if len(self.node.nodes) == 1:
+                    item = self.node.nodes[0].lazy(item, path)
+                elif not self.node.check_item(item):
+                    raise ValidationError(path, expected=self.node.scheme, actual=item)
+            except ValidationError, e:
+                item = e
+            self.checked[index] = item
+        if type(item) is ValidationError:
+            raise item
+        return item
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return "<lazy %r>" % (self.data,)
+
+
+def lazy(scheme, data):
+    """
+    Checks only the shape of data right away and returns read-only view
+    of it, where nested dicts and lists are checked when they are first
+    accessed. Accessing invalid part of data raises ValidationError,
+    so does calling lazy if the shape is wrong. Parts of data that were
+    checked as a whole are returned as they are.
+
+    >>> request = lazy({'id': int, 'items': [{'price': int}]}, {'id': 1, 'items': [{'price': 1}, {'price': '2'}]})
+    >>> request['id'], request['items'][0]['price']
+    (1, 1)
+    >>> request['items'][1]['price']
+    Traceback (most recent call last):
+    ...
+    ValidationError: Invalid data at $['items'][1]['price']
+    >>> lazy({'id': int}, {'name': 'foo'})
+    Traceback (most recent call last):
+    ...
+    ValidationError: Unexpected key at $['name']
+    """
+    return _compiled(scheme).node.lazy(data, ())
+
+
+### Detailed errors ###
+
+class _Enough(Exception):
+    pass
+
+
+class _Errors(list):
+    """ ValidationErrors found by explain methods of nodes, up to max_errors. """
+    def __init__(self, max_errors):
+        list.__init__(self)
+        self.max_errors = max_errors
+
+    def add(self, path, expected, actual, message="Invalid data"):
+        self.append(ValidationError(path, message, expected, actual))
+        if len(self) >= self.max_errors:
+            raise _Enough()
+
+    def check(self, node, data, path):
+        if not node.check(data):
+            node.explain(data, path, self)
+
+
+def validate_detailed(scheme, data, max_errors=1):
+    """
+    Validates data against scheme and returns list of ValidationErrors,
+    which is empty if data is valid. Valid data costs as much as validate,
+    only invalid data is walked again to find out what is wrong with it,
+    until max_errors errors are found (None for all of them).
+
+    >>> validate_detailed({'id': int, 'tags': [str]}, {'id': 1, 'tags': ['foo']})
+    []
+    >>> error, = validate_detailed({'id': int, 'tags': [str]}, {'id': 1, 'tags': ['foo', 2]})
+    >>> error
+    ValidationError("Invalid data at $['tags'][1]",)
+    >>> error.path, error.expected, error.actual
+    (('tags', 1), <type 'str'>, 2)
+    >>> validate_detailed({'id': int, 'tags': [str]}, {'tags': [1, 2]}, max_errors=None)
+    [ValidationError("Invalid data at $['tags'][0]",), ValidationError("Invalid data at $['tags'][1]",), ValidationError("Missing key at $['id']",)]
+    """
+    node = _compiled(scheme).node
+    if node.check(data):
+        return []
+    errors = _Errors(max_errors or float('inf'))
+    try:
+        node.explain(data, (), errors)
+    except _Enough:
+        pass
+    return list(errors)
+
+
+### Iterative validation ###
+
+MAX_DEPTH = 100000
+
+class _Choice(tuple):
+    """ Returned by split instead of (node, data) pairs, when any one of them is enough. """
+    __slots__ = ()
+
+
+class TooDeep(RuntimeError):
+    """
+    Raised by validate_iterative when a part of data can not be split (say,
+    a dict key that can be taken by several validators) and is too deep to
+    be checked recursively.
+    """
+
+
+def validate_iterative(scheme, data, max_depth=MAX_DEPTH):
+    """
+    Same as validate, but walks nested lists, tuples and dicts using a stack
+    of its own rather than recursion, so very deep data does not hit
+    recursion limit of python. Alternatives (AnyOf, lists with several
+    validators) are tried one after another on the stack as well. Data
+    nested deeper than max_depth is invalid.
+
+    >>> validate_iterative([[int]], [[1], [2, 3]])
+    True
+    >>> validate_iterative([[int]], [[1], [2, '3']])
+    False
+    >>> validate_iterative([[int]], [[1], [2, 3]], max_depth=1)
+    False
+    """
+    # every frame is (iterator of (node, data) pairs, True if any one of them
+    # is enough and False if all of them must be valid); valid is what the
+    # last frame that was popped turned out to be
+    stack = [(iter(((_compiled(scheme).node, data),)), False)]
+    valid = True
+    try:
+        while stack:
+            pairs, choice = stack[-1]
+            if valid is choice: # decided by the frame popped last
+                stack.pop()
+                continue
+            for node, value in pairs:
+                result = node.split(value)
+                while type(result) is tuple and len(result) == 1: # Ref, Optional, ...
+                    node, value = result[0]
+                    result = node.split(value)
+                if result is None:
+                    result = bool(node.check(value))
+                if result is True or result is False:
+                    if result is choice:
+                        valid = choice
+                        stack.pop()
+                        break
+                else:
+                    if len(stack) >= max_depth:
+                        return False
+                    choice = type(result) is _Choice
+                    stack.append((iter(result), choice))
+                    valid = not choice
+                    break
+            else:
+                stack.pop()
+                valid = not choice
+    except RuntimeError, e:
+        if "recursion" not in str(e):
+            raise
+        raise TooDeep("Data is too deep to be checked recursively")
+    return valid
+
+
+### Validation of many records ###
+
+_worker_check = None
+
+def _init_worker(scheme):
+    global _worker_check
+    _worker_check = compile(scheme).check
+
+def _check_chunk(chunk, check=None):
+    """ Returns indices of invalid records in chunk. """
+    check = check or _worker_check
+    return [i for i, data in enumerate(chunk) if not check(data)]
+
+def _chunks(iterable, chunksize):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+def validate_many(scheme, iterable, workers=None, mode="process", chunksize=1000, only_invalid=False):
+    """
+    Validates every record from iterable against scheme, using a pool
+    of workers processes (or threads, if mode is "thread"). Every worker
+    compiles the scheme once and gets records in chunks of chunksize.
+    Default number of workers is number of CPUs, with workers=1 everything
+    is done in the calling process.
+
+    Returns list of results in the same order as records, or just indices
+    of invalid records if only_invalid is true.
+
+    >>> validate_many([int], [[1, 2], [3], ['4']], workers=1)
+    [True, True, False]
+    >>> validate_many([int], [[1, 2], [3], ['4']], workers=2, chunksize=2, only_invalid=True)
+    [2]
+
+    Processes are forked with the scheme already in them, so schemes that
+    cannot be pickled (e.g. with lambdas in them) are fine.
+    """
+    import multiprocessing.pool
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if mode not in ("process", "thread"):
+        raise ValueError("Unknown mode: %r" % (mode,))
+    chunks = _chunks(iterable, chunksize)
+    if workers <= 1:
+        check = compile(scheme).check
+        return _collect(((len(chunk), _check_chunk(chunk, check)) for chunk in chunks), only_invalid)
+    if mode == "process":
+        pool = multiprocessing.Pool(workers, _init_worker, (scheme,))
+        check_chunk = _check_chunk
+    else:
+        pool = multiprocessing.pool.ThreadPool(workers)
+        check = compile(scheme).check
+        check_chunk = lambda chunk: _check_chunk(chunk, check)
+    try:
+        return _collect(_imap_bounded(pool, check_chunk, chunks, workers * 2), only_invalid)
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _imap_bounded(pool, function, chunks, limit):
+    """
+    Like pool.imap, but keeps at most limit chunks in flight instead of
+    reading the whole input into the task queue.
+    Yields (size of chunk, result) in the original order.
+    """
+    pending = deque()
+    for chunk in chunks:
+        pending.append((len(chunk), pool.apply_async(function, (chunk,))))
+        if len(pending) >= limit:
+            size, result = pending.popleft()
+            yield size, result.get()
+    while pending:
+        size, result = pending.popleft()
+        yield size, result.get()
+
+def _collect(results, only_invalid):
+    """ Turns (size of chunk, invalid indices) pairs into the result of validate_many. """
+    collected = []
+    offset = 0
+    for size, invalid in results:
+        if only_invalid:
+            collected.extend(offset + i for i in invalid)
+        else:
+            valid = [True] * size
+            for i in invalid:
+                valid[i] = False
+            collected.extend(valid)
+        offset += size
+    return collected
+
+
+### Streaming ###
+
+class _JSONArrayReader(object):
+    """
+    Reads items of a top level JSON array from a file one by one, keeping
+    in memory only a buffer with the item being decoded.
+    """
+    whitespace = re.compile(r'[ \t\n\r]*')
+    error_pos = re.compile(r'\(char (\d+)')
+    max_item = 1 << 26 # longer items are taken for garbage
+
+    def __init__(self, fileobj, buffer_size):
+        import json
+        self.fileobj = fileobj
+        self.buffer_size = buffer_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """ Reads more data into the buffer, dropping what was decoded already. """
+        if self.eof:
+            return False
+        # read at least as much as we have, so long items are not re-decoded too often
+        chunk = self.fileobj.read(max(self.buffer_size, len(self.buffer) - self.pos))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def next_char(self):
+        """ Skips whitespace and returns next character, '' at the end of input. """
+        while True:
+            self.pos = self.whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, chars):
+        char = self.next_char()
+        if not char or char not in chars:
+            raise ValueError("Expected one of %r at offset %d, got %r" % (chars, self.pos, char))
+        self.pos += 1
+        return char
+
+    def truncated(self, error):
+        """ Whether decoding may have failed only because the item is not read in full. """
+        if str(error).startswith("Unterminated string"):
+            return True
+        match = self.error_pos.search(str(error))
+        # the longest token cut at the end of the buffer is -Infinity
+        return match is None or int(match.group(1)) > len(self.buffer) - len('-Infinity')
+
+    def decode(self):
+        while True:
+            try:
+                item, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError, e:
+                if not self.truncated(e):
+                    raise
+                if len(self.buffer) - self.pos > self.max_item:
+                    raise ValueError("Item at offset %d is longer than %d bytes" % (self.pos, self.max_item))
+                if not self.fill():
+                    raise
+                continue
+            # 12 may turn out to be the beginning of 123 or 12e3 when we read more
+            if end < len(self.buffer) - len('-Infinity') or not self.fill():
+                self.pos = end
+                return item
+
+    def __iter__(self):
+        self.expect('[')
+        if self.next_char() == ']':
+            self.pos += 1
+        else:
+            while True:
+                self.next_char()
+                yield self.decode()
+                if self.expect(',]') == ']':
+                    break
+        if self.next_char():
+            raise ValueError("Extra data at offset %d" % self.pos)
+
+
+def validate_stream(scheme, source, fail_fast=False, buffer_size=65536):
+    """
+    Validates items of a list one by one, as they are read. source is either
+    a file with a JSON array in it, or any iterable. scheme is a list scheme,
+    like [int] or [{'id': int}].
+    Yields (index, result) for every item; with fail_fast stops after the
+    first invalid one. Only the item being validated is kept in memory.
+
+    >>> from StringIO import StringIO
+    >>> list(validate_stream([int], StringIO('[1, 2, "3", 4]')))
+    [(0, True), (1, True), (2, False), (3, True)]
+    >>> list(validate_stream([int], StringIO('[1, 2, "3", 4]'), fail_fast=True))
+    [(0, True), (1, True), (2, False)]
+
+    Raises ValueError if the file is not a JSON array.
+    """
+    if type(scheme) is not list:
+        raise TypeError("Only list schemes can be streamed")
+    node = compile(scheme).node
+    if len(node.nodes) == 1:
+        check = node.nodes[0].check
+    else:
+        check = node.check_item
+    if hasattr(source, 'read'):
+        source = _JSONArrayReader(source, buffer_size)
+    for index, item in enumerate(source):
+        result = bool(check(item))
+        yield index, result
+        if fail_fast and not result:
+            return
+
+
+### Decoding ###
+# json.loads builds the whole document before we can look at it. Here the
+# document is decoded top down, with the compiled scheme telling what to
+# expect next, so invalid parts are found (and decoding stopped) as soon as
+# they are read. Parts of the scheme that cannot tell much about what is
+# coming (callables, dicts with Many keys, ...) get decoded by the stock
+# decoder and validated afterwards.
+
+class _SchemeDecoder(object):
+    whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, text):
+        import json
+        self.text = text
+        self.decoder = json.JSONDecoder()
+        self.scanstring = json.decoder.scanstring
+
+    def skip(self, pos):
+        return self.whitespace.match(self.text, pos).end()
+
+    def decode(self, node, pos, path):
+        """ Returns (value, end) for value at pos, which must be valid for node. """
+        decode = self.decoders.get(type(node))
+        if decode is not None:
+            result = decode(self, node, pos, path)
+            if result is not None:
+                return result
+        value, end = self.decoder.raw_decode(self.text, pos)
+        if not node.check(value):
+            raise ValidationError(path)
+        return value, end
+
+    def expect(self, pos, chars):
+        pos = self.skip(pos)
+        char = self.text[pos:pos + 1]
+        if not char or char not in chars:
+            raise ValueError("Expected one of %r at offset %d" % (chars, pos))
+        return char, pos + 1
+
+    def decode_optional(self, node, pos, path):
+        if self.text.startswith('null', pos):
+            return None, pos + 4
+        return self.decode(node.node, pos, path)
+
+    def decode_many(self, node, pos, path):
+        return self.decode(node.node, pos, path)
+
+    def decode_list(self, node, pos, path):
+        if len(node.nodes) != 1:
+            return None
+        item_node = node.nodes[0]
+        if self.text[pos:pos + 1] != '[':
+            raise ValidationError(path)
+        value = []
+        pos = self.skip(pos + 1)
+        if self.text[pos:pos + 1] == ']':
+            return value, pos + 1
+        while True:
+            item, pos = self.decode(item_node, self.skip(pos), path + (len(value),))
+            value.append(item)
+            char, pos = self.expect(pos, ',]')
+            if char == ']':
+                return value, pos
+
+    def decode_dict(self, node, pos, path):
+        if not node.plain:
+            return None
+        if self.text[pos:pos + 1] != '{':
+            raise ValidationError(path)
+        value = {}
+        pos = self.skip(pos + 1)
+        if self.text[pos:pos + 1] == '}':
+            if node.literals:
+                raise ValidationError(path)
+            return value, pos + 1
+        n_required = 0
+        while True:
+            char, pos = self.expect(pos, '"')
+            key, pos = self.scanstring(self.text, pos, 'utf-8', True)
+            char, pos = self.expect(pos, ':')
+            value_node = node.literals.get(key)
+            if value_node is not None:
+                if key not in value:
+                    n_required += 1
+            else:
+                value_node = node.optional_literals.get(key)
+                if value_node is None:
+                    raise ValidationError(path + (key,), "Unexpected key")
+            value[key], pos = self.decode(value_node, self.skip(pos), path + (key,))
+            char, pos = self.expect(pos, ',}')
+            if char == '}':
+                break
+        if n_required != len(node.literals):
+            raise ValidationError(path, "Missing key")
+        return value, pos
+
+    decoders = {
+        _OptionalNode: decode_optional,
+        _ManyNode: decode_many,
+        _ListNode: decode_list,
+        _DictNode: decode_dict,
+        }
+
+
+def loads(scheme, text):
+    """
+    Decodes JSON text and validates it against scheme in one go.
+    Returns decoded data. Raises ValidationError as soon as invalid part
+    of data is found, without decoding the rest, and ValueError if text is
+    not JSON at all. Keep in mind that JSON strings are decoded as unicode.
+
+    >>> loads({'id': int, 'tags': [Text()]}, '{"id": 1, "tags": ["foo"]}')
+    {u'id': 1, u'tags': [u'foo']}
+    >>> loads({'id': int, 'tags': [Text()]}, '{"id": 1, "tags": ["foo", 2, ...')
+    Traceback (most recent call last):
+    ...
+    ValidationError: Invalid data at $[u'tags'][1]
+
+    When a key repeats, every value of it has to be valid, even though only
+    the last one is kept.
+    """
+    decoder = _SchemeDecoder(text)
+    value, end = decoder.decode(_compiled(scheme).node, decoder.skip(0), ())
+    end = decoder.skip(end)
+    if end != len(text):
+        raise ValueError("Extra data at offset %d" % end)
+    return value
+
+
+### Profiling ###
+
+class _ProfiledNode(_Node):
+    """ Wraps a node and records its calls into stats of the profiler. """
+    __slots__ = ('node', 'stats', 'profiler')
+
+    def __init__(self, node, stats, profiler):
+        _Node.__init__(self, node.scheme)
+        self.node = node
+        self.stats = stats
+        self.profiler = profiler
+        self.types = node.types
+        self.exact = node.exact
+
+    def validate(self, data):
+        stack = self.profiler.stack
+        stack.append(0.0) # time spent in nested nodes
+        started = default_timer()
+        try:
+            result = self.node.check(data)
+        finally:
+            elapsed = default_timer() - started
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            stats = self.stats
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] += elapsed - nested
+        stats[3 if result else 4] += 1
+        return result
+
+
+class Profiler(object):
+    """
+    Records, for every part of a scheme, how many times it was checked,
+    how much time it took (with and without nested parts) and how many
+    times data passed or failed. Parts of the scheme are named by their
+    path, e.g. ['items'][*]['price'].
+
+    >>> profiler = Profiler()
+    >>> validate({'items': [{'price': int}]}, {'items': [{'price': 1}]}, profiler=profiler)
+    True
+    >>> profiler.stats[("['items']", '[*]', "['price']")][0] # calls
+    1
+
+    Profiler is not thread safe, use one per thread.
+    """
+    def __init__(self):
+        self.stats = {} # {path: [calls, total time, self time, passed, failed]}
+        self.stack = []
+        self.compiled = {}
+
+    def compile(self, scheme):
+        """ Compiles scheme with every node recording into this profiler. """
+        try:
+            return self.compiled[id(scheme)][1]
+        except KeyError:
+            pass
+        compiled = Compiled(scheme, _Compiler(self.wrap).compile(scheme))
+        self.compiled[id(scheme)] = (scheme, compiled)
+        return compiled
+
+    def wrap(self, node, path):
+        stats = self.stats.setdefault(path, [0, 0.0, 0.0, 0, 0])
+        return _ProfiledNode(node, stats, self)
+
+    def reset(self):
+        for stats in self.stats.itervalues():
+            stats[:] = [0, 0.0, 0.0, 0, 0]
+
+    @staticmethod
+    def format_path(path):
+        return "".join(path) or "(root)"
+
+    def table(self, sort="self", limit=None):
+        """
+        Returns stats as a text table, sorted by "self" or "total" time
+        or by number of "calls".
+        """
+        column = {"calls": 0, "total": 1, "self": 2}[sort]
+        rows = sorted(self.stats.iteritems(), key=lambda item: item[1][column], reverse=True)
+        lines = ["%10s %12s %12s %10s %10s  %s" % ("calls", "total ms", "self ms", "passed", "failed", "path")]
+        for path, (calls, total, own, passed, failed) in rows[:limit]:
+            if calls:
+                lines.append("%10d %12.3f %12.3f %10d %10d  %s" %
+                             (calls, total * 1000, own * 1000, passed, failed, self.format_path(path)))
+        return "\n".join(lines)
+
+    def folded(self):
+        """
+        Returns self time in microseconds in folded stacks format, which is
+        understood by flamegraph.pl and similar tools.
+        """
+        lines = []
+        for path, stats in sorted(self.stats.iteritems()):
+            if stats[0]:
+                frames = ["(root)"] + [part.replace(";", ",") for part in path]
+                lines.append("%s %d" % (";".join(frames), round(stats[2] * 1e6)))
+        return "\n".join(lines)
+
+
+### Cost limits ###
+
+class LimitExceeded(object):
+    """
+    Result of validate when data was too costly to check, see Limits.
+    It is false, like the result for invalid data, and its limit
+    attribute names the limit that was hit, e.g. "max_items".
+    """
+    __slots__ = ('limit',)
+
+    def __init__(self, limit):
+        self.limit = limit
+
+    def __nonzero__(self):
+        return False
+
+    def __eq__(self, other):
+        return type(other) is LimitExceeded and other.limit == self.limit
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.limit)
+
+    def __repr__(self):
+        return "LimitExceeded(%r)" % (self.limit,)
+
+
+class _OverBudget(Exception):
+    pass
+
+
+class _Budget(object):
+    """ Work done by a single validate call with limits. """
+    __slots__ = ('ops', 'items', 'depth', 'max_ops', 'max_items', 'max_depth', 'deadline')
+
+    def __init__(self, limits):
+        self.ops = 0
+        self.items = 0
+        self.depth = 0
+        self.max_ops = _or_infinity(limits.max_ops)
+        self.max_items = _or_infinity(limits.max_items)
+        self.max_depth = _or_infinity(limits.max_depth)
+        if limits.deadline is None:
+            self.deadline = _or_infinity(None)
+        else:
+            self.deadline = default_timer() + limits.deadline
+
+
+def _or_infinity(value):
+    return float('inf') if value is None else value
+
+
+_budgets = threading.local()
+
+class _LimitedNode(_Node):
+    """
+    Wraps a node and charges every check to the budget of the current call.
+    Only nodes of dicts, lists and tuples charge for items and depth, so
+    data is not charged twice when it passes through Refs and the like.
+    """
+    __slots__ = ('node', 'container')
+
+    def __init__(self, node):
+        _Node.__init__(self, node.scheme)
+        self.node = node
+        self.container = type(node) in (_DictNode, _ListNode, _TupleNode)
+        self.types = node.types
+        self.exact = node.exact
+
+    def validate(self, data):
+        budget = _budgets.current
+        budget.ops += 1
+        if budget.ops > budget.max_ops:
+            raise _OverBudget("max_ops")
+        if not budget.ops & 0xff and default_timer() > budget.deadline:
+            raise _OverBudget("deadline")
+        if not self.container or type(data) not in self.node.types:
+            return self.node.check(data)
+        budget.items += len(data)
+        if budget.items > budget.max_items:
+            raise _OverBudget("max_items")
+        budget.depth += 1
+        if budget.depth > budget.max_depth:
+            raise _OverBudget("max_depth")
+        try:
+            return self.node.check(data)
+        finally:
+            budget.depth -= 1
+
+
+class Limits(object):
+    """
+    Bounds the work validate may do on a single piece of data, so that
+    untrusted input can not make it slow:
+
+    max_items -- total number of items in all dicts, lists and tuples checked
+    max_depth -- how deep these containers may be nested
+    max_ops -- how many times parts of the scheme may be checked
+    deadline -- how many seconds validation may take
+
+    Limits left as None are not checked. When a limit is hit validation
+    stops and validate returns LimitExceeded, which is false.
+
+    >>> limits = Limits(max_items=100)
+    >>> validate([int], range(10), limits=limits)
+    True
+    >>> validate([int], range(1000), limits=limits)
+    LimitExceeded('max_items')
+    >>> validate([int], ['1'], limits=limits)
+    False
+    """
+    def __init__(self, max_items=None, max_depth=None, max_ops=None, deadline=None):
+        self.max_items = max_items
+        self.max_depth = max_depth
+        self.max_ops = max_ops
+        self.deadline = deadline
+
+    def __repr__(self):
+        return "Limits(max_items=%r, max_depth=%r, max_ops=%r, deadline=%r)" % \
+            (self.max_items, self.max_depth, self.max_ops, self.deadline)
+
+
+_limited_cache = {}
+
+def _validate_limited(scheme, data, limits):
+    node = _compiled_with(_limited_cache, scheme, lambda node, path: _LimitedNode(node))
+    outer = getattr(_budgets, 'current', None)
+    _budgets.current = _Budget(limits)
+    try:
+        return node.check(data)
+    except _OverBudget, e:
+        return LimitExceeded(e.args[0])
+    finally:
+        _budgets.current = outer
+
+
+### Sampling ###
+
+class Sample(object):
+    """
+    Makes validate check only some of the items of every list, and of
+    the dict items that can only be taken by Many keys, picked at random:
+    count of them, or fraction of them, or at least count and at least
+    fraction if both are given. The same seed picks the same items.
+    Other parts of the data are checked as usual.
+
+    With a sample validate returns Sampled, which is true or false as the
+    result would be and tells in its checked attribute how many list items
+    and dict items were checked.
+
+    >>> result = validate([int], range(1000), sample=Sample(count=10, seed=1))
+    >>> bool(result), result.checked
+    (True, 10)
+    >>> result = validate({'id': int, Many(str): [int]},
+    ...                   {'id': 1, 'a': range(100), 'b': range(100)},
+    ...                   sample=Sample(fraction=0.1, seed=1))
+    >>> bool(result), result.checked
+    (True, 12)
+    """
+    def __init__(self, fraction=None, count=None, seed=None):
+        if fraction is None and count is None:
+            raise ValueError("Sample needs fraction or count")
+        self.fraction = fraction
+        self.count = count
+        self.seed = seed
+
+    def size(self, length):
+        """ Returns how many of length items to check, at least one of them. """
+        size = 1
+        if self.count is not None:
+            size = max(size, self.count)
+        if self.fraction is not None:
+            size = max(size, int(math.ceil(self.fraction * length)))
+        return min(size, length)
+
+    def __repr__(self):
+        return "Sample(fraction=%r, count=%r, seed=%r)" % (self.fraction, self.count, self.seed)
+
+
+class Sampled(object):
+    """ Result of validate with a sample, see Sample. """
+    __slots__ = ('valid', 'checked')
+
+    def __init__(self, valid, checked):
+        self.valid = valid
+        self.checked = checked
+
+    def __nonzero__(self):
+        return bool(self.valid)
+
+    def __repr__(self):
+        return "Sampled(%r, checked=%r)" % (self.valid, self.checked)
+
+
+class _Sampler(object):
+    """ Picks items for a single validate call with a sample. """
+    __slots__ = ('sample', 'random', 'checked')
+
+    def __init__(self, sample):
+        import random
+        self.sample = sample
+        self.random = random.Random(sample.seed)
+        self.checked = 0
+
+    def sample_list(self, data):
+        size = self.sample.size(len(data))
+        if size < len(data):
+            data = self.random.sample(data, size)
+        self.checked += size
+        return data
+
+    def sample_dict(self, data, keep):
+        rest = [key for key in data if key not in keep]
+        size = self.sample.size(len(rest))
+        if size < len(rest):
+            picked = dict((key, data[key]) for key in self.random.sample(rest, size))
+            for key in keep:
+                if key in data:
+                    picked[key] = data[key]
+            data = picked
+        self.checked += len(data)
+        return data
+
+
+_samplers = threading.local()
+
+class _SampledNode(_Node):
+    """
+    Wraps a list or dict node and passes it a sample of data. Dicts are
+    sampled only if all their keys are plain values or Many validators,
+    then items of plain keys are always kept and the rest is sampled.
+    """
+    __slots__ = ('node', 'keep')
+
+    def __init__(self, node):
+        _Node.__init__(self, node.scheme)
+        self.node = node
+        self.keep = None
+        if type(node) is _DictNode and not node.optional and \
+                all(is_many for i, is_many, key, value in node.required):
+            self.keep = frozenset(node.literals) | frozenset(node.optional_literals)
+        self.types = node.types
+        self.exact = node.exact
+
+    def validate(self, data):
+        if type(data) is list:
+            data = _samplers.current.sample_list(data)
+        elif type(data) is dict:
+            if self.keep is None:
+                _samplers.current.checked += len(data)
+            else:
+                data = _samplers.current.sample_dict(data, self.keep)
+        return self.node.check(data)
+
+
+def _sample_wrap(node, path):
+    if type(node) is _ListNode or type(node) is _DictNode:
+        return _SampledNode(node)
+    return node
+
+_sampled_cache = {}
+
+def _validate_sampled(scheme, data, sample):
+    node = _compiled_with(_sampled_cache, scheme, _sample_wrap)
+    outer = getattr(_samplers, 'current', None)
+    sampler = _samplers.current = _Sampler(sample)
+    try:
+        return Sampled(node.check(data), sampler.checked)
+    finally:
+        _samplers.current = outer
+
+
+### Memoization ###
+
+def pure(function):
+    """
+    Marks function (or validator class) as depending on nothing but its
+    argument, so Memo may remember what it returned.
+
+    >>> @pure
+    ... def positive(x):
+    ...     return x > 0
+    >>> positive.validol_pure
+    True
+    """
+    function.validol_pure = True
+    return function
+
+
+_FINGERPRINT_ATOMS = frozenset([str, unicode, int, long, float, bool, complex, type(None)])
+
+def _fingerprint(data):
+    """
+    Returns hashable value that is equal only for data of the same types
+    and values (1, 1.0 and True are equal, but validate tells them apart).
+    Raises TypeError for data that is not immutable.
+    """
+    data_type = type(data)
+    if data_type in _FINGERPRINT_ATOMS:
+        return (data_type, data)
+    elif data_type is tuple:
+        return (data_type, tuple(imap(_fingerprint, data)))
+    elif data_type is frozenset:
+        return (data_type, frozenset(imap(_fingerprint, data)))
+    raise TypeError("Can not fingerprint %r" % (data_type,))
+
+
+def _is_pure(node, seen):
+    """ Tells if result of node depends on nothing but data. """
+    if id(node) in seen:
+        return True
+    seen.add(id(node))
+    node_type = type(node)
+    if node_type is _MemoNode:
+        return True
+    elif node_type is _FunctionNode or node_type is _ValidatorNode:
+        return getattr(node.scheme, 'validol_pure', False)
+    elif node_type is _CoerceNode:
+        return getattr(node.fn, 'validol_pure', False) and _is_pure(node.node, seen)
+    elif node_type is _RefNode:
+        return node.node is not None and _is_pure(node.node, seen)
+    elif node_type in (_OptionalNode, _ManyNode, _DefaultNode):
+        return _is_pure(node.node, seen)
+    elif node_type in (_AnyOfNode, _TupleNode, _ListNode):
+        return all(_is_pure(child, seen) for child in node.nodes)
+    elif node_type is _TaggedNode:
+        return all(_is_pure(child, seen) for child in node.nodes.itervalues())
+    elif node_type is _DictNode:
+        return all(_is_pure(child, seen) for child in node.optional_literals.itervalues()) and \
+            all(_is_pure(child, seen) for child in node.literals.itervalues()) and \
+            all(_is_pure(key, seen) and _is_pure(value, seen) for key, value in node.optional) and \
+            all(_is_pure(key, seen) and _is_pure(value, seen)
+                for i, is_many, key, value in node.required)
+    return node_type in (_ObjectNode, _TypeNode, _ValueNode, _RegexNode, _TextNode)
+
+
+class _MemoNode(_Node):
+    """ Wraps a node and remembers its results in the memo. """
+    __slots__ = ('node', 'memo')
+
+    def __init__(self, node, memo):
+        _Node.__init__(self, node.scheme)
+        self.node = node
+        self.memo = memo
+        self.types = node.types
+        self.exact = node.exact
+
+    def validate(self, data):
+        try:
+            key = (self.node, _fingerprint(data))
+        except TypeError:
+            return self.node.check(data)
+        memo = self.memo
+        cache = memo.cache
+        try:
+            result = cache.pop(key)
+        except KeyError:
+            memo.misses += 1
+            result = self.node.check(data)
+            if len(cache) >= memo.size:
+                cache.popitem(last=False)
+        else:
+            memo.hits += 1
+        cache[key] = result
+        return result
+
+
+# cheaper to check than to look up, or take data that can not be remembered
+_NOT_MEMOIZED = frozenset([_ObjectNode, _TypeNode, _ValueNode, _TextNode,
+                           _DictNode, _ListNode, _TaggedNode])
+
+class Memo(object):
+    """
+    Remembers results of validation of immutable data (atoms, tuples and
+    frozensets of them) for every part of a scheme, so data that comes
+    again and again is not checked again. Only size results are kept,
+    least recently used are forgotten first.
+
+    Parts of scheme that check data by its type alone are not worth it
+    and are not remembered. Neither are callables and custom validators,
+    unless they are marked with pure, nor anything that has them inside.
+
+    >>> memo = Memo(size=1000)
+    >>> scheme = [(int, re.compile('^[a-z]+$'))]
+    >>> validate(scheme, [(1, 'foo'), (1, 'foo'), (2, 'bar')], memo=memo)
+    True
+    >>> memo.hits, memo.misses # tuples and strings
+    (1, 4)
+
+    Memo is not thread safe, use one per thread.
+    """
+    def __init__(self, size=10000):
+        self.size = size
+        self.cache = collections.OrderedDict() # {(node, fingerprint of data): result}
+        self.hits = 0
+        self.misses = 0
+        self.compiled = {}
+
+    def compile(self, scheme):
+        """ Compiles scheme with results of its parts remembered in this memo. """
+        try:
+            return self.compiled[id(scheme)][1]
+        except KeyError:
+            pass
+        compiled = Compiled(scheme, _Compiler(self.wrap).compile(scheme))
+        self.compiled[id(scheme)] = (scheme, compiled)
+        return compiled
+
+    def wrap(self, node, path):
+        node_type = type(node)
+        if node.exact or node_type in _NOT_MEMOIZED or \
+                node_type is _TupleNode and node.check != node.validate or \
+                not _is_pure(node, set()):
+            return node
+        return _MemoNode(node, self)
+
+    def clear(self):
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+### Command line ###
+
+def _load_scheme(name):
+    """ Loads scheme from "package.module:attribute" """
+    module_name, _, attribute = name.partition(':')
+    if not attribute:
+        raise ValueError("Scheme must be given as module:attribute, got %r" % (name,))
+    scheme = __import__(module_name, fromlist=['*'])
+    for part in attribute.split('.'):
+        scheme = getattr(scheme, part)
+    return scheme
+
+def _split_lines(data, parts):
+    """ Splits mmap-ed data into up to parts (start, end) ranges on line boundaries. """
+    size = len(data)
+    ranges = []
+    start = 0
+    for i in xrange(1, parts + 1):
+        if start >= size:
+            break
+        end = size * i // parts
+        if end < start:
+            continue
+        newline = data.find('\n', end)
+        end = size if newline == -1 or i == parts else newline + 1
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+def _check_lines(path, start, end, check=None):
+    """
+    Validates JSON lines of path between offsets start and end.
+    Returns (number of lines, indices of invalid lines).
+    """
+    import json
+    import mmap
+    check = check or _worker_check
+    invalid = []
+    n_lines = 0
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pos = start
+            while pos < end:
+                newline = data.find('\n', pos, end)
+                if newline == -1:
+                    newline = end
+                line = data[pos:newline]
+                if line.strip():
+                    try:
+                        valid = check(json.loads(line))
+                    except ValueError:
+                        valid = False
+                    if not valid:
+                        invalid.append(n_lines)
+                n_lines += 1
+                pos = newline + 1
+        finally:
+            data.close()
+    return n_lines, invalid
+
+def _check_lines_task(args):
+    return _check_lines(*args)
+
+def main(argv=None):
+    """
+    python -m validol module:scheme file.jsonl
+
+    Validates every line of a JSON Lines file against scheme and prints
+    numbers of invalid lines (counting from 1). The file is split between
+    worker processes on line boundaries. Exit status is 1 if there are
+    invalid lines. Keep in mind that JSON strings are decoded as unicode.
+    """
+    import argparse
+    import mmap
+    import multiprocessing
+    parser = argparse.ArgumentParser(prog="python -m validol",
+                                     description="Validates JSON Lines file against a scheme.")
+    parser.add_argument('scheme', help="where to take the scheme from, e.g. myapp.schemes:EVENT")
+    parser.add_argument('path', help="JSON Lines file")
+    parser.add_argument('-w', '--workers', type=int, default=multiprocessing.cpu_count(),
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout,
+                        help="where to write numbers of invalid lines (default: stdout)")
+    args = parser.parse_args(argv)
+
+    scheme = _load_scheme(args.scheme)
+    started = default_timer()
+    with open(args.path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                # a few ranges per worker, so a slow range does not hold everybody
+                ranges = _split_lines(data, max(args.workers, 1) * 4)
+            finally:
+                data.close()
+        else:
+            ranges = []
+    tasks = [(args.path, start, end) for start, end in ranges]
+    if args.workers <= 1:
+        check = compile(scheme).check
+        results = [_check_lines(path, start, end, check) for path, start, end in tasks]
+    else:
+        pool = multiprocessing.Pool(args.workers, _init_worker, (scheme,))
+        try:
+            results = pool.map(_check_lines_task, tasks, chunksize=1)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    n_lines = 0
+    n_invalid = 0
+    for lines, invalid in results:
+        for i in invalid:
+            args.output.write("%d\n" % (n_lines + i + 1))
+        n_lines += lines
+        n_invalid += len(invalid)
+    args.output.flush()
+    elapsed = max(default_timer() - started, 1e-9)
+    sys.stderr.write("%d lines, %d invalid, %.1f lines/s, %.2f MB/s\n" %
+                     (n_lines, n_invalid, n_lines / elapsed, size / elapsed / 2 ** 20))
+    return 1 if n_invalid else 0
+
+
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        # schemes import validol, so use that module and not __main__,
+        # otherwise there would be two different sets of validator classes
+        import validol
+        sys.exit(validol.main())
+    # without arguments run doctests, as always
     import doctest
     doctest.testmod()